@@ -0,0 +1,153 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import software_lib
+
+FICLONE = 0x40049409
+
+
+def _clone(src: str, dest: str) -> None:
+    """Reflinks src to dest, falls back to a hardlink and then to a copy"""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of downloaded server artifacts
+
+    Objects are stored as objects/<sha256> and indexed by a key like
+    "Paper/1.20.4/496". The least recently used objects are evicted once the
+    store holds more than max_bytes.
+    """
+
+    def __init__(
+        self,
+        root: str = "/var/andromeda/artifacts/",
+        max_bytes: int = 4 * 1024**3,
+    ) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(self.root + "objects", exist_ok=True)
+        os.makedirs(self.root + "tmp", exist_ok=True)
+        try:
+            with open(self.root + "index.json", "r") as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = {"keys": {}, "objects": {}}
+
+    def _save_index(self) -> None:
+        with open(self.root + "index.json.tmp", "w") as f:
+            json.dump(self._index, f)
+        os.replace(self.root + "index.json.tmp", self.root + "index.json")
+
+    def _object_path(self, sha256: str) -> str:
+        return self.root + "objects/" + sha256
+
+    def _lookup(self, key: str, url: str) -> str | None:
+        entry = self._index["keys"].get(key)
+        if not entry or entry["url"] != url:
+            return None
+        obj = self._index["objects"].get(entry["sha256"])
+        path = self._object_path(entry["sha256"])
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if obj is None or mtime is None:
+            return None
+        if mtime != obj["mtime"] and _sha256(path) != entry["sha256"]:
+            os.remove(path)
+            del self._index["objects"][entry["sha256"]]
+            return None
+        obj["mtime"] = mtime
+        obj["used"] = time.time()
+        return path
+
+    def _add(self, key: str, url: str, path: str) -> str:
+        sha256 = _sha256(path)
+        obj_path = self._object_path(sha256)
+        if os.path.exists(obj_path):
+            os.remove(path)
+        else:
+            os.replace(path, obj_path)
+        self._index["keys"][key] = {"url": url, "sha256": sha256}
+        self._index["objects"][sha256] = {
+            "size": os.path.getsize(obj_path),
+            "mtime": os.stat(obj_path).st_mtime_ns,
+            "used": time.time(),
+        }
+        self._evict(keep=sha256)
+        return obj_path
+
+    def _evict(self, keep: str) -> None:
+        objects = self._index["objects"]
+        total = sum(obj["size"] for obj in objects.values())
+        for sha256 in sorted(objects, key=lambda sha256: objects[sha256]["used"]):
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            total -= objects.pop(sha256)["size"]
+            if os.path.exists(self._object_path(sha256)):
+                os.remove(self._object_path(sha256))
+        self._index["keys"] = {
+            key: entry
+            for key, entry in self._index["keys"].items()
+            if entry["sha256"] in objects
+        }
+
+    def fetch(
+        self,
+        key: str,
+        url: str,
+        dest: str,
+        checksum: tuple | None = None,
+        on_progress=None,
+    ) -> bool:
+        """
+        Populates dest with the artifact for key, downloading it on a miss.
+        Returns True if it was served from the store.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                path = self._lookup(key, url)
+                if path:
+                    _clone(path, dest)
+                    self._save_index()
+                    return True
+
+            tmp = self.root + "tmp/" + hashlib.sha256((key + url).encode()).hexdigest()
+            software_lib.download(url, tmp, checksum, on_progress)
+            with self._lock:
+                path = self._add(key, url, tmp)
+                _clone(path, dest)
+                self._save_index()
+            return False
@@ -0,0 +1,173 @@
+import concurrent.futures
+import gzip
+import json
+import os
+import shutil
+import time
+
+EXCLUDE = ("logs", "crash-reports", "cache")
+
+
+def _compress(src: str, dest: str) -> int:
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open(src, "rb") as fin, gzip.open(dest, "wb", compresslevel=6) as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+    return os.stat(dest).st_size
+
+
+def _decompress(src: str, dest: str) -> None:
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with gzip.open(src, "rb") as fin, open(dest, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+
+
+class BackupStore:
+    """
+    Incremental, deduplicated instance backups
+
+    Every backup is a directory <root>/<server>/<id>/ holding a manifest and
+    a gzip-compressed copy of every file under files/. Directories and
+    symlinks are only recorded in the manifest. Files whose size and
+    mtime match the previous backup are hardlinked to it instead of stored
+    again, so each backup only costs the space of the files that changed and
+    any backup can be deleted or restored on its own. Changed files are
+    compressed in a pool of worker processes.
+    """
+
+    def __init__(self, root: str, workers: int = 4, exclude: tuple = EXCLUDE) -> None:
+        self.root = root
+        self.workers = workers
+        self.exclude = exclude
+
+    def list(self, name: str) -> list:
+        try:
+            ids = sorted(os.listdir(self.root + name))
+        except FileNotFoundError:
+            return []
+        backups = []
+        for backup_id in ids:
+            if backup_id.endswith(".partial"):
+                continue
+            with open(f"{self.root}{name}/{backup_id}/manifest.json", "r") as f:
+                manifest = json.load(f)
+            backups.append({"id": backup_id, **manifest["stats"]})
+        return backups
+
+    def _manifest(self, name: str, backup_id: str) -> dict:
+        with open(f"{self.root}{name}/{backup_id}/manifest.json", "r") as f:
+            return json.load(f)
+
+    def _scan(self, source: str) -> tuple:
+        """Returns (files, directories, symlinks) under source by relative path"""
+        files = {}
+        directories = {}
+        links = {}
+        for root, dirs, filenames in os.walk(source):
+            if root == source:
+                dirs[:] = [d for d in dirs if d not in self.exclude]
+            for dirname in dirs:
+                path = os.path.join(root, dirname)
+                if os.path.islink(path):
+                    links[os.path.relpath(path, source)] = os.readlink(path)
+                else:
+                    directories[os.path.relpath(path, source)] = (
+                        os.lstat(path).st_mode & 0o7777
+                    )
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if os.path.islink(path):
+                    links[os.path.relpath(path, source)] = os.readlink(path)
+                    continue
+                stat = os.lstat(path)
+                files[os.path.relpath(path, source)] = [
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    stat.st_mode & 0o7777,
+                ]
+        return files, directories, links
+
+    def create(self, name: str, source: str, keep: int = 0) -> dict:
+        """
+        Backs up source, returns the new backup's stats. Only the newest
+        keep backups are kept, 0 keeps all of them.
+        """
+        backups = self.list(name)
+        previous = backups[-1]["id"] if backups else None
+        previous_files = self._manifest(name, previous)["files"] if previous else {}
+
+        backup_id = time.strftime("%Y%m%d-%H%M%S")
+        if previous and backup_id <= previous:
+            backup_id = previous + "-1"
+        path = f"{self.root}{name}/{backup_id}"
+        partial = path + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial + "/files")
+
+        started = time.monotonic()
+        files, directories, links = self._scan(source)
+        stats = {"created": time.time(), "files": len(files), "linked": 0}
+        stats["size"] = sum(info[0] for info in files.values())
+        changed = []
+        for relpath, info in files.items():
+            dest = f"{partial}/files/{relpath}"
+            if previous_files.get(relpath) == info:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.link(f"{self.root}{name}/{previous}/files/{relpath}", dest)
+                stats["linked"] += 1
+            else:
+                changed.append(relpath)
+
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+            stored = pool.map(
+                _compress,
+                [f"{source}/{relpath}" for relpath in changed],
+                [f"{partial}/files/{relpath}" for relpath in changed],
+                chunksize=16,
+            )
+            stats["stored"] = sum(stored)
+        stats["seconds"] = round(time.monotonic() - started, 3)
+
+        with open(partial + "/manifest.json", "w") as f:
+            json.dump(
+                {
+                    "stats": stats,
+                    "files": files,
+                    "directories": directories,
+                    "links": links,
+                },
+                f,
+            )
+        os.rename(partial, path)
+
+        if keep:
+            for backup in backups[: max(len(backups) + 1 - keep, 0)]:
+                shutil.rmtree(f"{self.root}{name}/{backup['id']}")
+        return {"id": backup_id, **stats}
+
+    def restore(self, name: str, backup_id: str, dest: str) -> None:
+        """Restores a backup into dest, which must not exist yet"""
+        if backup_id not in [backup["id"] for backup in self.list(name)]:
+            raise KeyError(backup_id)
+        manifest = self._manifest(name, backup_id)
+        files = manifest["files"]
+        directories = manifest.get("directories", {})
+        os.makedirs(dest)
+        for relpath in directories:
+            os.makedirs(f"{dest}/{relpath}", exist_ok=True)
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+            for _ in pool.map(
+                _decompress,
+                [f"{self.root}{name}/{backup_id}/files/{relpath}" for relpath in files],
+                [f"{dest}/{relpath}" for relpath in files],
+                chunksize=16,
+            ):
+                pass
+        for relpath, (_, mtime_ns, mode) in files.items():
+            os.chmod(f"{dest}/{relpath}", mode)
+            os.utime(f"{dest}/{relpath}", ns=(mtime_ns, mtime_ns))
+        for relpath, target in manifest.get("links", {}).items():
+            os.makedirs(os.path.dirname(f"{dest}/{relpath}"), exist_ok=True)
+            os.symlink(target, f"{dest}/{relpath}")
+        # deepest first, so a read-only directory does not block its children
+        for relpath in sorted(directories, key=len, reverse=True):
+            os.chmod(f"{dest}/{relpath}", directories[relpath])
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Load tests for stall
+
+    bench.py console [--servers 4] [--clients 20] [--rate 200] [--duration 10]
+        Starts fake instances that print --rate lines/s each, attaches
+        --clients websocket clients (auth + startconsolelogging, round robin
+        over the servers) and reports console latency percentiles, frame and
+        line throughput and the CPU and memory use of the stall process.
+
+    bench.py install [--count 5] [--software Paper] [--jar-size 40000000]
+        Installs --count servers against a local stand-in of the metadata
+        APIs and reports how long each took to show up in the server list.
+
+Stall is started from this checkout in dbg mode, in a temporary directory
+with its own settings, instance, artifact, backup and cache folders; nothing
+under /var/andromeda is touched.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import websockets
+from fake_api import FakeApi
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+AUTHHASH = "bench"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Stall:
+    """A stall process running from this checkout inside workdir"""
+
+    def __init__(self, workdir: str, software_api: dict) -> None:
+        self.workdir = workdir
+        self.port = free_port()
+        self.uri = f"ws://127.0.0.1:{self.port}"
+        self.instance_folder = workdir + "/instances/"
+        self.settings_file = workdir + "/global_settings.andromeda.json"
+        self.process = None
+        os.makedirs(self.instance_folder)
+        self._fake_jvm()
+        with open(self.settings_file, "w") as f:
+            json.dump(
+                {
+                    "authhash": AUTHHASH,
+                    "ssl": False,
+                    "host": "127.0.0.1",
+                    "port": self.port,
+                    "instance_folder": self.instance_folder,
+                    "artifact_folder": workdir + "/artifacts/",
+                    "backup_folder": workdir + "/backups/",
+                    "cache_folder": workdir + "/cache/",
+                    "jvm_dir": workdir + "/jvm",
+                    "software_api": software_api,
+                    "log_level": "warning",
+                },
+                f,
+            )
+
+    def _fake_jvm(self) -> None:
+        os.makedirs(self.workdir + "/jvm/fake-17/bin")
+        with open(self.workdir + "/jvm/fake-17/release", "w") as f:
+            f.write('JAVA_VERSION="17.0.9"\n')
+        with open(self.workdir + "/jvm/fake-17/bin/java", "w") as f:
+            f.write("#!/bin/sh\necho 'openjdk version \"17.0.9\"' >&2\n")
+        os.chmod(self.workdir + "/jvm/fake-17/bin/java", 0o755)
+
+    def add_instance(self, name: str, rate: float) -> None:
+        os.makedirs(self.instance_folder + name)
+        with open(self.instance_folder + name + "/run.sh", "w") as f:
+            f.write(
+                f"#!/bin/sh\nexec {sys.executable} {BENCH_DIR}/fake_instance.py --rate {rate}\n"
+            )
+        os.chmod(self.instance_folder + name + "/run.sh", 0o755)
+        with open(self.instance_folder + name + "/settings.andromeda.json", "w") as f:
+            json.dump({"software": "Paper", "mc_version": "1.20.4"}, f)
+
+    def start(self) -> None:
+        self.process = subprocess.Popen(
+            (sys.executable, REPO_DIR + "/server.py", "dbg"),
+            cwd=self.workdir,
+            env={**os.environ, "ANDROMEDA_SETTINGS": self.settings_file},
+            stdout=open(self.workdir + "/stall.out", "w"),
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"stall exited, see {self.workdir}/stall.out")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("stall did not come up")
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+    def usage(self) -> tuple:
+        """Returns (cpu seconds, rss, peak rss) of the stall process"""
+        with open(f"/proc/{self.process.pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        status = {}
+        with open(f"/proc/{self.process.pid}/status", "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                status[key] = value.strip()
+        return (
+            (int(fields[11]) + int(fields[12])) / CLK_TCK,
+            int(fields[21]) * PAGE_SIZE,
+            int(status["VmHWM"].split()[0]) * 1024,
+        )
+
+
+async def connect(uri: str):
+    ws = await websockets.connect(uri, max_size=None)
+    await ws.send(json.dumps({"data": "auth", "hash": AUTHHASH}))
+    return ws
+
+
+async def console_client(uri: str, server_name: str, stats: dict, until: float):
+    async with await connect(uri) as ws:
+        await ws.send(
+            json.dumps({"data": "startconsolelogging", "server_name": server_name})
+        )
+        buffer = ""
+        while (timeout := until - time.time()) > 0:
+            try:
+                message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+            except asyncio.TimeoutError:
+                break
+            now = time.time()
+            stats["frames"] += 1
+            if message["data"] == "lagged":
+                stats["dropped"] += message["dropped"]
+            if message["data"] != "console_logging":
+                continue
+            stats["bytes"] += len(message["msg"])
+            buffer += message["msg"]
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if " @" in line:
+                    stats["lines"] += 1
+                    stats["latencies"].append(now - float(line.rsplit(" @", 1)[1]))
+
+
+async def wait_for(ws, predicate, timeout: float = 30):
+    deadline = time.time() + timeout
+    while True:
+        message = json.loads(
+            await asyncio.wait_for(ws.recv(), max(deadline - time.time(), 0.01))
+        )
+        if predicate(message):
+            return message
+
+
+async def bench_console(args, stall: Stall) -> None:
+    names = [f"bench-{i}" for i in range(args.servers)]
+    control = await connect(stall.uri)
+    await wait_for(control, lambda m: m["data"] == "welcome")
+    running = set()
+    for name in names:
+        await control.send(json.dumps({"data": "startserver", "server_name": name}))
+    while running != set(names):
+        message = await wait_for(control, lambda m: m["data"] == "serverstate")
+        if message["state"] == "running":
+            running.add(message["server"])
+
+    stats = {"frames": 0, "lines": 0, "bytes": 0, "dropped": 0, "latencies": []}
+    cpu_before = stall.usage()[0]
+    started = time.time()
+    await asyncio.gather(
+        *(
+            console_client(
+                stall.uri, names[i % len(names)], stats, started + args.duration
+            )
+            for i in range(args.clients)
+        )
+    )
+    elapsed = time.time() - started
+    cpu_after, rss, peak_rss = stall.usage()
+
+    for name in names:
+        await control.send(
+            json.dumps(
+                {"data": "console_write", "server_name": name, "content": "stop\n"}
+            )
+        )
+    await control.close()
+
+    latencies = [latency * 1000 for latency in stats["latencies"]]
+    print(
+        f"servers={args.servers} clients={args.clients} rate={args.rate} lines/s/server duration={elapsed:.1f}s"
+    )
+    print(
+        "console latency ms: "
+        f"p50={percentile(latencies, 50):.1f} p95={percentile(latencies, 95):.1f} "
+        f"p99={percentile(latencies, 99):.1f} max={max(latencies, default=float('nan')):.1f}"
+    )
+    print(
+        f"frames/s={stats['frames'] / elapsed:.0f} lines/s={stats['lines'] / elapsed:.0f} "
+        f"KiB/s={stats['bytes'] / elapsed / 1024:.0f} dropped={stats['dropped']}"
+    )
+    print(
+        f"stall cpu={(cpu_after - cpu_before) / elapsed * 100:.1f}% "
+        f"rss={rss / 1024**2:.1f}MiB peak_rss={peak_rss / 1024**2:.1f}MiB"
+    )
+
+
+async def bench_install(args, stall: Stall, api: FakeApi) -> None:
+    versions = {"Paper": "2", "Fabric": "0.15.0", "Vanilla": ""}
+    control = await connect(stall.uri)
+    await wait_for(control, lambda m: m["data"] == "welcome")
+
+    started = {}
+    finished = {}
+    for i in range(args.count):
+        name = f"install-{i}"
+        started[name] = time.time()
+        await control.send(
+            json.dumps(
+                {
+                    "data": "installserver",
+                    "mcversion": "1.20.4",
+                    "software": args.software,
+                    "softwareversion": versions[args.software],
+                    "name": name,
+                }
+            )
+        )
+    while len(finished) < args.count:
+        message = await wait_for(
+            control, lambda m: m["data"] in ("serverlist", "exception"), 600
+        )
+        if message["data"] == "exception":
+            print("install failed:", message)
+            break
+        for name in message["servers"]:
+            if name in started and name not in finished:
+                finished[name] = time.time() - started[name]
+    await control.close()
+
+    jars = sum(1 for path in api.requests if path.endswith("jar"))
+    print(f"software={args.software} count={args.count} jar_size={args.jar_size}")
+    for name, seconds in finished.items():
+        print(f"{name}: {seconds:.2f}s")
+    print(
+        f"total={max(finished.values(), default=0):.2f}s upstream requests={len(api.requests)} jar downloads={jars}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    console = commands.add_parser("console")
+    console.add_argument("--servers", type=int, default=4)
+    console.add_argument("--clients", type=int, default=20)
+    console.add_argument("--rate", type=float, default=200)
+    console.add_argument("--duration", type=float, default=10)
+    install = commands.add_parser("install")
+    install.add_argument("--count", type=int, default=5)
+    install.add_argument(
+        "--software", choices=("Paper", "Fabric", "Vanilla"), default="Paper"
+    )
+    install.add_argument("--jar-size", type=int, default=40 * 1024**2)
+    install.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="stall-bench-") as workdir:
+        api = FakeApi(
+            jar_size=getattr(args, "jar_size", 1024),
+            latency=getattr(args, "latency", 0),
+        ).start()
+        stall = Stall(workdir, api.software_api())
+        if args.command == "console":
+            for i in range(args.servers):
+                stall.add_instance(f"bench-{i}", args.rate)
+        stall.start()
+        try:
+            if args.command == "console":
+                asyncio.run(bench_console(args, stall))
+            else:
+                asyncio.run(bench_install(args, stall, api))
+        finally:
+            stall.stop()
+            api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Paper, Mojang, Fabric and Forge metadata APIs and
+their jar downloads, so install paths can be exercised offline.
+
+Serves one Minecraft version (1.20.4) per software, answers conditional
+requests with 304 and honours Range requests. Point stall at it with the
+software_api global setting returned by FakeApi.software_api().
+
+    fake_api.py [--port 29880] [--jar-size 40000000] [--latency 0.05]
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import threading
+import time
+
+MC_VERSION = "1.20.4"
+
+
+class FakeApi:
+    def __init__(
+        self, port: int = 0, jar_size: int = 40 * 1024**2, latency: float = 0
+    ) -> None:
+        self.latency = latency
+        self.jar = os.urandom(jar_size)
+        self.requests = []
+        self.httpd = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", port), self._handler()
+        )
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        sha1 = hashlib.sha1(self.jar).hexdigest()
+        sha256 = hashlib.sha256(self.jar).hexdigest()
+        self.documents = {
+            "/paper": {"versions": [MC_VERSION]},
+            f"/paper/versions/{MC_VERSION}": {"builds": [1, 2]},
+            f"/paper/versions/{MC_VERSION}/builds/1": {
+                "downloads": {"application": {"sha256": sha256}}
+            },
+            f"/paper/versions/{MC_VERSION}/builds/2": {
+                "downloads": {"application": {"sha256": sha256}}
+            },
+            "/vanilla/version_manifest.json": {
+                "versions": [
+                    {
+                        "id": MC_VERSION,
+                        "type": "release",
+                        "url": f"{self.url}/vanilla/{MC_VERSION}.json",
+                    }
+                ]
+            },
+            f"/vanilla/{MC_VERSION}.json": {
+                "downloads": {
+                    "server": {"url": f"{self.url}/vanilla/server.jar", "sha1": sha1}
+                }
+            },
+            "/fabric/": {
+                "game": [{"version": MC_VERSION, "stable": True}],
+                "loader": [{"version": "0.15.0"}],
+                "installer": [{"version": "1.0.0"}],
+            },
+            "/forge": {
+                "versions": [
+                    {"version": "49.0.1", "requires": [{"equals": MC_VERSION}]}
+                ]
+            },
+        }
+
+    def software_api(self) -> dict:
+        return {
+            "vanilla": {"url": self.url + "/vanilla/version_manifest.json"},
+            "paper": {
+                "url": self.url + "/paper",
+                "download_api_url": self.url + "/paper",
+            },
+            "fabric": {"url": self.url + "/fabric/"},
+            "forge": {"url": self.url + "/forge", "maven_url": self.url + "/maven"},
+        }
+
+    def _handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.requests.append(self.path)
+                if api.latency:
+                    time.sleep(api.latency)
+                if self.path in api.documents:
+                    body = json.dumps(api.documents[self.path]).encode()
+                    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+                    if self.headers.get("If-None-Match") == etag:
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("ETag", etag)
+                elif self.path.endswith(".jar") or self.path.endswith("/server/jar"):
+                    body = api.jar
+                    start = 0
+                    if self.headers.get("Range"):
+                        start = int(self.headers["Range"][6:].split("-")[0])
+                        body = body[start:]
+                        self.send_response(206)
+                    else:
+                        self.send_response(200)
+                    self.send_header("Content-Type", "application/java-archive")
+                else:
+                    self.send_error(404)
+                    return
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "FakeApi":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=29880)
+    parser.add_argument("--jar-size", type=int, default=40 * 1024**2)
+    parser.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+    api = FakeApi(args.port, args.jar_size, args.latency)
+    print(json.dumps({"software_api": api.software_api()}, indent=2))
+    api.httpd.serve_forever()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Stand-in for a Minecraft server's run.sh
+
+Prints Minecraft-like log lines at --rate lines per second. Every line ends
+with the wall clock time it was printed at ("@<unix time>"), so clients can
+measure console latency. Exits on "stop" like a real server.
+
+    fake_instance.py [--rate 50] [--startup 1]
+"""
+
+import argparse
+import random
+import select
+import sys
+import time
+
+LINES = (
+    "Preparing spawn area: 42%",
+    "Saving chunks for level 'ServerLevel[world]'/minecraft:overworld",
+    "Steve joined the game",
+    "Steve lost connection: Disconnected",
+    "Can't keep up! Is the server overloaded? Running 2043ms or 40 ticks behind",
+    "[PluginManager] Enabling ExamplePlugin v1.0.0",
+    "\033[33m[WorldEdit] Loaded 312 block mappings\033[0m",
+    "Alex has made the advancement [Stone Age]",
+)
+
+
+def log(message: str, thread: str = "Server thread", level: str = "INFO") -> None:
+    print(f"[{time.strftime('%H:%M:%S')}] [{thread}/{level}]: {message}", flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=50)
+    parser.add_argument("--startup", type=float, default=1)
+    args = parser.parse_args()
+
+    log("Starting minecraft server version 1.20.4", "main")
+    time.sleep(args.startup)
+    log(f'Done ({args.startup:.3f}s)! For help, type "help"')
+    log(f"Time elapsed: {int(args.startup * 1000)} ms")
+
+    interval = 1 / args.rate if args.rate else None
+    next_line = time.monotonic()
+    while True:
+        timeout = max(0, next_line - time.monotonic()) if interval else None
+        if select.select([sys.stdin], [], [], timeout)[0]:
+            line = sys.stdin.readline()
+            if not line or line.strip() == "stop":
+                log("Stopping server")
+                log("Saving worlds")
+                return
+            log(f"Unknown command: {line.strip()}")
+        if interval and time.monotonic() >= next_line:
+            log(f"{random.choice(LINES)} @{time.time():.6f}")
+            next_line += interval
+
+
+if __name__ == "__main__":
+    main()
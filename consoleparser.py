@@ -0,0 +1,87 @@
+import re
+
+# CSI (colours, cursor movement, erase), OSC (window title), charset selection
+# and the remaining two byte sequences like ESC = (keypad mode)
+_ANSI = re.compile(
+    r"\x1b\[[0-?]*[ -/]*[@-~]"
+    r"|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)"
+    r"|\x1b[()*+][0-9A-Za-z]"
+    r"|\x1b[ -~]"
+)
+# "[12:34:56] [Server thread/INFO]: ", "[12:34:56 INFO]: ",
+# "[12:34:56] [Server thread/INFO] [minecraft/DedicatedServer]: "
+_PREFIX = re.compile(r"(?:\[[^\]]*\] ?)+: ?")
+
+_VANILLA = (
+    ("ready", re.compile(r'Done \((?P<seconds>[\d.]+)s\)! For help, type "help"')),
+    ("stopping", re.compile(r"Stopping (?:the )?server")),
+    ("saved", re.compile(r"Saved the game")),
+    ("join", re.compile(r"(?P<player>[\w.]{1,16}) joined the game")),
+    ("leave", re.compile(r"(?P<player>[\w.]{1,16}) left the game")),
+    (
+        "lag",
+        re.compile(
+            r"Can't keep up! Is the server overloaded\? "
+            r"Running (?P<ms>\d+)ms or (?P<ticks>\d+) ticks behind"
+        ),
+    ),
+    ("crash", re.compile(r"This crash report has been saved to: (?P<path>.+)")),
+    ("crash", re.compile(r"Encountered an unexpected exception")),
+)
+
+PATTERNS = {
+    "vanilla": _VANILLA,
+    "fabric": _VANILLA,
+    "paper": _VANILLA
+    + (
+        ("ready", re.compile(r"Time elapsed: (?P<ms>\d+) ms")),
+        ("crash", re.compile(r"The server has stopped responding!")),
+    ),
+    "forge": _VANILLA
+    + (("crash", re.compile(r"Preparing crash report with UUID (?P<uuid>\S+)")),),
+}
+
+
+class ConsoleParser:
+    """
+    Turns raw console output into structured events
+
+    Output arrives in arbitrary chunks, so partial lines are kept until their
+    newline arrives. Of every complete line only the text after its last
+    carriage return is kept, as that is what the terminal ends up showing
+    when a prompt (like Paper's JLine "> ") is redrawn around log output.
+    Escape sequences and the log prefix are then stripped and the message is
+    matched against the pattern table of the server software. Only the start
+    of the message is matched, so chat can't fake events. ready is reported
+    once per parser.
+
+    feed returns a list of events like {"event": "join", "player": "Steve"}.
+    """
+
+    def __init__(self, software: str = "vanilla", max_line: int = 64 * 1024) -> None:
+        self.patterns = PATTERNS.get(software.lower(), _VANILLA)
+        self.max_line = max_line
+        self._partial = ""
+        self._ready = False
+
+    def feed(self, output: str) -> list:
+        lines = (self._partial + output).split("\n")
+        self._partial = lines.pop()
+        if len(self._partial) > self.max_line:
+            lines.append(self._partial)
+            self._partial = ""
+
+        events = []
+        for line in lines:
+            line = _ANSI.sub("", line.rstrip("\r").rsplit("\r", 1)[-1])
+            prefix = _PREFIX.match(line)
+            message = line[prefix.end() :] if prefix else line
+            for event, pattern in self.patterns:
+                if match := pattern.match(message):
+                    if event == "ready":
+                        if self._ready:
+                            break
+                        self._ready = True
+                    events.append({"event": event, **match.groupdict()})
+                    break
+        return events
@@ -0,0 +1,458 @@
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+import traceback
+import websockets
+from websockets.sync.client import connect
+from wsserver import WebSocket, WebSocketServer
+import logger
+import wire
+
+d = json.dumps
+
+# Coordinator mode: one endpoint for panels in front of several stall agents.
+# Server names are qualified with the agent name ("<agent>/<server>"), queue
+# task ids likewise ("<agent>/<id>").
+#
+# settings:
+#
+# {
+#   authhash : Hash panels log in with
+#   host : (optional) Listen address, default 0.0.0.0
+#   port : (optional) Listen port, default 29837
+#   ssl, certfile, keyfile : TLS like in the stall settings
+#   poll_interval : (optional) Seconds between agent load polls, default 5
+#   agents : [{ name, url ("ws://host:29836"), authhash, verify_ssl (optional) }]
+# }
+
+
+class AgentConnection:
+    """
+    Websocket connection to a stall agent
+
+    Logs in to the agent and hands every message it sends to
+    on_message(connection, message) on a reader thread. send can be called
+    from any thread and (re)opens the connection when it is down.
+    """
+
+    def __init__(self, agent: dict, on_message, on_close=None) -> None:
+        self.agent = agent
+        self.name = agent["name"]
+        self.on_message = on_message
+        self.on_close = on_close
+        self._ws = None
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    def _ssl_context(self):
+        if not self.agent["url"].startswith("wss://"):
+            return None
+        context = ssl.create_default_context()
+        if not self.agent.get("verify_ssl", True):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def _open(self):
+        if self._ws is None:
+            opened = threading.Event()
+            failure = []
+            threading.Thread(
+                target=self._run, args=(opened, failure), daemon=True
+            ).start()
+            opened.wait()
+            if failure:
+                raise failure[0]
+        return self._ws
+
+    def open(self) -> None:
+        with self._lock:
+            self._open()
+
+    def send(self, message: dict) -> None:
+        with self._lock:
+            self._open().send(d(message))
+
+    def _run(self, opened: threading.Event, failure: list) -> None:
+        try:
+            with connect(
+                self.agent["url"],
+                ssl=self._ssl_context(),
+                proxy=None,
+                max_size=None,
+                open_timeout=5,
+            ) as ws:
+                ws.send(d({"data": "auth", "hash": self.agent["authhash"]}))
+                self._ws = ws
+                opened.set()
+                for data in ws:
+                    try:
+                        self.on_message(self, wire.decode(data))
+                    except Exception:
+                        print("Exception occured:\n" + traceback.format_exc())
+        except (OSError, websockets.WebSocketException) as e:
+            failure.append(e)
+        finally:
+            if not opened.is_set():
+                opened.set()
+                return
+            self._ws = None
+            if self.on_close:
+                self.on_close(self)
+
+    def close(self) -> None:
+        with self._lock:
+            ws, self._ws = self._ws, None
+        if ws:
+            ws.close()
+
+
+def qualify(agent: str, message: dict) -> dict:
+    """Prefixes the server names and task ids of an agent's message with the agent name"""
+    message = {**message, "agent": agent}
+    for key in ("server", "console"):
+        if key in message:
+            message[key] = f"{agent}/{message[key]}"
+    for key in ("servers", "states", "instances"):
+        if isinstance(message.get(key), dict):
+            message[key] = {f"{agent}/{k}": v for k, v in message[key].items()}
+    if isinstance(message.get("queue"), list):
+        message["queue"] = [
+            {
+                **task,
+                "id": f"{agent}/{task['id']}",
+                **({"key": f"{agent}/{task['key']}"} if task.get("key") else {}),
+            }
+            for task in message["queue"]
+        ]
+    return message
+
+
+def route(message: dict) -> tuple:
+    """Returns (agent, message for the agent) for a qualified panel message"""
+    for key in ("server_name", "name", "task_id"):
+        if isinstance(message.get(key), str) and "/" in message[key]:
+            agent, value = message[key].split("/", 1)
+            return agent, {**message, key: int(value) if key == "task_id" else value}
+    return message.get("agent"), message
+
+
+def on_monitor_message(connection: AgentConnection, message: dict) -> None:
+    agent = agents[connection.name]
+    with agents_lock:
+        match message["data"]:
+            case "serverlist":
+                agent["servers"] = message["servers"]
+                agent["states"] = message["states"]
+                if "queue" in message:
+                    agent["queue"] = message["queue"]
+            case "serverstate":
+                agent["states"][message["server"]] = message["state"]
+            case "queue":
+                agent["queue"] = message["queue"]
+            case "metrics":
+                agent["host"] = message["host"]
+                agent["instances"] = message["instances"]
+                agent["placed"] = 0
+
+
+def poll_agents() -> None:
+    while True:
+        for name, agent in agents.items():
+            try:
+                agent["connection"].send({"data": "listservers"})
+                agent["connection"].send({"data": "getmetrics"})
+            except (OSError, websockets.WebSocketException) as e:
+                if agent["connection"].connected or agent["host"]:
+                    global_logger.log(f"Agent {name} unavailable: {e}", logger.WARNING)
+                agent["host"] = {}
+        time.sleep(global_settings.get("poll_interval", 5))
+
+
+def running(agent: dict) -> int:
+    return sum(state != "stopped" for state in agent["states"].values())
+
+
+def place_install() -> str | None:
+    """Picks the reachable agent with the most available memory per running instance"""
+    with agents_lock:
+        return _place_install()
+
+
+def _place_install() -> str | None:
+    candidates = [
+        (
+            agent["host"]["mem_available"] / (running(agent) + agent["placed"] + 1),
+            name,
+        )
+        for name, agent in agents.items()
+        if agent["connection"].connected and agent["host"]
+    ]
+    if not candidates:
+        return None
+    name = max(candidates)[1]
+    agents[name]["placed"] += 1
+    return name
+
+
+def merged_serverlist() -> dict:
+    with agents_lock:
+        return _merged_serverlist()
+
+
+def _merged_serverlist() -> dict:
+    rt = {"data": "serverlist", "servers": {}, "states": {}, "queue": [], "agents": {}}
+    for name, agent in agents.items():
+        listing = qualify(
+            name,
+            {
+                "servers": agent["servers"],
+                "states": agent["states"],
+                "queue": agent["queue"],
+            },
+        )
+        rt["servers"].update(listing["servers"])
+        rt["states"].update(listing["states"])
+        rt["queue"].extend(listing["queue"])
+        rt["agents"][name] = {
+            "connected": agent["connection"].connected,
+            "running": running(agent),
+            "mem_available": agent["host"].get("mem_available"),
+        }
+    return rt
+
+
+class CoordinatorHandler(WebSocket):
+    def handleConnected(self):
+        self.agent_connections = {}
+        global_logger.log(f"{self.address[0]} CONNECTED")
+
+    def handleClose(self):
+        if self in authed_clients:
+            authed_clients.remove(self)
+        for connection in self.agent_connections.values():
+            connection.close()
+        global_logger.log(f"{self.address[0]} DISCONNECTED")
+
+    def forward(self, connection: AgentConnection, message: dict) -> None:
+        match message["data"]:
+            case "welcome":
+                return
+            case "serverlist":
+                # a panel replaces its list on these, so it gets every agent's
+                on_monitor_message(connection, message)
+                return self.sendMessage(d(merged_serverlist()))
+            case "queue":
+                on_monitor_message(connection, message)
+                return self.sendMessage(
+                    {"data": "queue", "queue": merged_serverlist()["queue"]}
+                )
+            case "serverstate":
+                on_monitor_message(connection, message)
+        self.sendMessage(
+            qualify(connection.name, message),
+            droppable=message["data"] == "console_logging",
+        )
+
+    def on_agent_close(self, connection: AgentConnection) -> None:
+        if self in authed_clients:
+            self.sendMessage(
+                {"data": "agentstatus", "agent": connection.name, "connected": False}
+            )
+
+    def send_to_agent(self, name: str, message: dict | None = None) -> None:
+        """Sends message to an agent over this panel's connection, opening it if needed"""
+        if name not in self.agent_connections:
+            self.agent_connections[name] = AgentConnection(
+                agents[name]["settings"], self.forward, self.on_agent_close
+            )
+        try:
+            if message is None:
+                self.agent_connections[name].open()
+            else:
+                self.agent_connections[name].send(message)
+        except (OSError, websockets.WebSocketException) as e:
+            self.sendMessage(
+                d(
+                    {
+                        "data": "exception",
+                        "msg": f"agent unavailable: {e}",
+                        "agent": name,
+                    }
+                )
+            )
+
+    def handleMessage(self):
+        try:
+            json_data = wire.decode(self.data)
+        except ValueError:
+            return self.sendMessage(
+                '{"data": "exception", "msg": "json parsing error"}'
+            )
+
+        global_logger.log(
+            f"{self.address[0]} MESSAGE: {global_logger.payload(json_data)}",
+            logger.DEBUG if json_data.get("data") == "console_write" else logger.INFO,
+        )
+
+        if json_data["data"] != "auth" and self not in authed_clients:
+            return self.sendMessage('{"data": "exception", "msg": "not authed"}')
+
+        try:
+            match json_data["data"]:
+                case "auth":
+                    if json_data["hash"] != global_settings["authhash"]:
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid login"}'
+                        )
+                    encoding = json_data.get("encoding", "json")
+                    if encoding not in wire.ENCODINGS:
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "unsupported encoding"}'
+                        )
+                    self.encoding = encoding
+                    if self not in authed_clients:
+                        authed_clients.append(self)
+                    # agent connections carry the agents' broadcasts to this panel
+                    for name, agent in agents.items():
+                        if agent["connection"].connected:
+                            self.send_to_agent(name)
+                    return self.sendMessage(
+                        {"data": "welcome", "encoding": encoding, "coordinator": True}
+                    )
+
+                case "listservers":
+                    return self.sendMessage(d(merged_serverlist()))
+
+                case "getmetrics":
+                    return self.sendMessage(
+                        {
+                            "data": "metrics",
+                            "agents": {
+                                name: {
+                                    "host": agent["host"],
+                                    "instances": agent["instances"],
+                                }
+                                for name, agent in agents.items()
+                            },
+                        }
+                    )
+
+                case "installserver":
+                    agent, message = route(json_data)
+                    if agent is None:
+                        agent = place_install()
+                        if agent is None:
+                            return self.sendMessage(
+                                '{"data": "exception", "msg": "no agent available"}'
+                            )
+                    if agent not in agents:
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid agent"}'
+                        )
+                    global_logger.log(f"Placing {message['name']} on agent {agent}")
+                    self.send_to_agent(agent, message)
+
+                case "getsoftwaredata" | "getbuilddata" if "agent" not in json_data:
+                    for name, agent in agents.items():
+                        if agent["connection"].connected:
+                            return self.send_to_agent(name, json_data)
+                    return self.sendMessage(
+                        '{"data": "exception", "msg": "no agent available"}'
+                    )
+
+                case _:
+                    agent, message = route(json_data)
+                    if agent is None:
+                        for name, connection in self.agent_connections.items():
+                            if connection.connected:
+                                self.send_to_agent(name, message)
+                    elif agent in agents:
+                        self.send_to_agent(agent, message)
+                    else:
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid agent"}'
+                        )
+        except ValueError:
+            return self.sendMessage('{"data": "exception", "msg": "invalid data"}')
+        except KeyError:
+            print("Exception occured:\n" + traceback.format_exc())
+            return self.sendMessage(
+                d(
+                    {
+                        "data": "exception",
+                        "msg": "missing data",
+                        "old_message": json_data,
+                    }
+                )
+            )
+
+
+with open(
+    os.environ.get(
+        "ANDROMEDA_COORDINATOR_SETTINGS",
+        "/var/andromeda/coordinator_settings.andromeda.json",
+    ),
+    "r",
+) as f:
+    global_settings = json.load(f)
+
+log_settings = {
+    "level": logger.LEVELS[global_settings.get("log_level", "info")],
+    "max_bytes": global_settings.get("log_max_bytes", 10 * 1024**2),
+    "backups": global_settings.get("log_backups", 5),
+}
+if len(sys.argv) >= 2 and sys.argv[1] == "dbg":
+    print("Using debugging log")
+    global_logger = logger.Logger("coordinator.log", **log_settings)
+else:
+    os.makedirs("/var/andromeda/log", exist_ok=True)
+    global_logger = logger.Logger("/var/andromeda/coordinator.log", **log_settings)
+global_logger.log("Welcome to Andromeda-Stall coordinator!")
+
+authed_clients = []
+# reader threads update the agent table while the dispatcher reads it
+agents_lock = threading.Lock()
+agents = {
+    agent["name"]: {
+        "settings": agent,
+        "connection": AgentConnection(agent, on_monitor_message),
+        "servers": {},
+        "states": {},
+        "queue": [],
+        "host": {},
+        "instances": {},
+        "placed": 0,
+    }
+    for agent in global_settings["agents"]
+}
+threading.Thread(target=poll_agents, daemon=True).start()
+
+if global_settings.get("ssl", False):
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(global_settings["certfile"], global_settings["keyfile"])
+else:
+    ssl_context = None
+socketserver = WebSocketServer(
+    global_settings.get("host", "0.0.0.0"),
+    global_settings.get("port", 29837),
+    CoordinatorHandler,
+    ssl_context,
+    global_settings.get("client_queue_size", 1024),
+    global_settings.get("client_console_backlog", 256),
+)
+global_logger.log("Coordinator is ready")
+try:
+    socketserver.serveforever()
+except KeyboardInterrupt:
+    socketserver.close()
+for agent in agents.values():
+    agent["connection"].close()
+global_logger.log("Andromeda-Stall coordinator stopped")
+global_logger.close()
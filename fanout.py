@@ -0,0 +1,78 @@
+import threading
+import time
+import traceback
+import wire
+
+
+class ConsoleFanout:
+    """
+    Batches console output per server and sends each batch as a single frame,
+    encoded once, to every websocket subscribed to that server's console.
+
+    A batch is flushed after flush_interval seconds or as soon as it grows to
+    max_batch bytes, whichever comes first. Frames carry the console history
+    offsets (start, end) of their output, so clients can resume from end.
+    """
+
+    def __init__(
+        self,
+        subscribers: dict,
+        flush_interval: float = 0.05,
+        max_batch: int = 16 * 1024,
+    ) -> None:
+        self.subscribers = subscribers
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._pending_size = {}
+        self._pending_start = {}
+        self._pending_end = {}
+        self._lock = threading.Condition()
+        self._flush_thread = threading.Thread(target=self._loop, daemon=True)
+        self._flush_thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                print("Exception occured:\n" + traceback.format_exc())
+
+    def push(self, server_name: str, output: str, start: int, end: int) -> None:
+        with self._lock:
+            if not self.subscribers.get(server_name):
+                return
+            self._pending_start.setdefault(server_name, start)
+            self._pending_end[server_name] = end
+            self._pending.setdefault(server_name, []).append(output)
+            size = self._pending_size.get(server_name, 0) + len(output)
+            self._pending_size[server_name] = size
+            if size >= self.max_batch:
+                self._flush_server(server_name)
+            else:
+                self._lock.notify()
+
+    def flush(self, server_name: str | None = None) -> None:
+        with self._lock:
+            for name in [server_name] if server_name else list(self._pending):
+                if name in self._pending:
+                    self._flush_server(name)
+
+    def _flush_server(self, server_name: str) -> None:
+        chunks = self._pending.pop(server_name)
+        del self._pending_size[server_name]
+        frame = wire.Frame(
+            {
+                "data": "console_logging",
+                "console": server_name,
+                "msg": "".join(chunks),
+                "start": self._pending_start.pop(server_name),
+                "end": self._pending_end.pop(server_name),
+            }
+        )
+        for client in list(self.subscribers.get(server_name, ())):
+            client.sendMessage(frame, droppable=True)
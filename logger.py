@@ -1,18 +1,135 @@
+import collections
+import json
 import os
+import threading
 import time
 
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+_LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
 
 class Logger:
-    def __init__(self, file_name) -> None:
+    """
+    Logger
+
+    log() only appends to an in-memory buffer, a background thread writes the
+    buffer out in batches every flush_interval seconds. If the buffer holds
+    buffer_size lines, new lines are dropped and counted instead.
+    The log file is rotated once it is larger than max_bytes or older than
+    max_age seconds, keeping the given number of backups.
+    """
+
+    def __init__(
+        self,
+        file_name,
+        level: int = INFO,
+        max_bytes: int = 10 * 1024**2,
+        max_age: float | None = None,
+        backups: int = 5,
+        buffer_size: int = 10000,
+        flush_interval: float = 1.0,
+        max_payload: int = 512,
+    ) -> None:
         self.pid = os.getpid()
         self.file = file_name
-        with open(self.file, "a") as f:
-            f.write("\n")
+        self.level = level
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_payload = max_payload
+        self._buffer = collections.deque()
+        self._dropped = 0
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._time_cache = (None, "")
+        self._f = open(self.file, "a")
+        self._opened = time.time()
+        self._f.write("\n")
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
 
-    def log(self, message: str) -> None:
+    def log(self, message: str, level: int = INFO) -> None:
+        if level < self.level:
+            return
         message = message.replace("\n", "").replace("\r", "")
-        print(f"[{time.strftime('%d/%b/%Y %H:%M:%S')}] {message} -")
-        with open(self.file, "a") as f:
-            f.write(
-                f"andromeda-stall[{self.pid}] [{time.strftime('%d/%b/%Y %H:%M:%S')}] {message} -\n"
+        with self._cond:
+            if len(self._buffer) >= self.buffer_size:
+                self._dropped += 1
+                return
+            self._buffer.append((time.time(), level, message))
+
+    def payload(self, data, redact: tuple = ("hash",)) -> str:
+        """Loggable form of a message payload: secrets redacted, long values cut"""
+        if isinstance(data, dict):
+            return json.dumps(
+                {
+                    key: "***" if key in redact else self._truncate(value)
+                    for key, value in data.items()
+                }
             )
+        return self._truncate(data)
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_payload:
+            return f"{value[:self.max_payload]}... ({len(value)} chars)"
+        return value
+
+    def _timestamp(self, t: float) -> str:
+        second = int(t)
+        if self._time_cache[0] != second:
+            self._time_cache = (
+                second,
+                time.strftime("%d/%b/%Y %H:%M:%S", time.localtime(second)),
+            )
+        return self._time_cache[1]
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def _rotate(self) -> None:
+        self._f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.file}.{i}"):
+                os.replace(f"{self.file}.{i}", f"{self.file}.{i + 1}")
+        if self.backups:
+            os.replace(self.file, self.file + ".1")
+        else:
+            os.remove(self.file)
+        self._f = open(self.file, "a")
+        self._opened = time.time()
+
+    def flush(self) -> None:
+        with self._cond:
+            lines, self._buffer = self._buffer, collections.deque()
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            lines.append((time.time(), WARNING, f"{dropped} log lines dropped"))
+        if not lines:
+            return
+
+        with self._write_lock:
+            for t, level, message in lines:
+                timestamp = self._timestamp(t)
+                print(f"[{timestamp}] {_LEVEL_NAMES[level]}: {message} -")
+                self._f.write(
+                    f"andromeda-stall[{self.pid}] [{timestamp}] {_LEVEL_NAMES[level]}: {message} -\n"
+                )
+                if self._f.tell() > self.max_bytes or (
+                    self.max_age and t - self._opened > self.max_age
+                ):
+                    self._rotate()
+            self._f.flush()
+
+    def close(self) -> None:
+        self.flush()
+        with self._write_lock:
+            self._f.close()
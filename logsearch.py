@@ -0,0 +1,273 @@
+import concurrent.futures
+import datetime
+import gzip
+import json
+import os
+import re
+import threading
+
+INDEX_FILE = ".search-index.json"
+BLOCK_LINES = 1024
+_TIME = re.compile(rb"\[(\d\d):(\d\d):(\d\d)")
+
+
+class _Clock:
+    """
+    Minecraft log lines only carry the time of day, this tracks the date,
+    moving to the next day whenever the time of day jumps backwards.
+    """
+
+    def __init__(self, day: datetime.date, tod: int = 0) -> None:
+        self.day = day
+        self.tod = tod
+        self.rollovers = 0
+        self._midnight = datetime.datetime.combine(day, datetime.time()).timestamp()
+
+    def tick(self, line: bytes) -> float:
+        if match := _TIME.match(line):
+            tod = int(match[1]) * 3600 + int(match[2]) * 60 + int(match[3])
+            if tod < self.tod - 12 * 3600:
+                self.day += datetime.timedelta(days=1)
+                self.rollovers += 1
+                self._midnight = datetime.datetime.combine(
+                    self.day, datetime.time()
+                ).timestamp()
+            self.tod = tod
+        return self._midnight + self.tod
+
+
+def _open(path: str):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def _file_day(path: str, mtime: float) -> datetime.date:
+    """Archives are named after their day (2024-01-31-1.log.gz), others use their mtime"""
+    try:
+        return datetime.date.fromisoformat(os.path.basename(path)[:10])
+    except ValueError:
+        return datetime.date.fromtimestamp(mtime)
+
+
+def _index_file(path: str, entry: dict | None) -> dict:
+    """
+    Indexes the lines of a log file: its time span and every BLOCK_LINES
+    lines an (offset, line number, time) block. Plain files that only grew
+    since entry was made are indexed from where entry stopped.
+    """
+    stat = os.stat(path)
+    resume = (
+        entry is not None
+        and not path.endswith(".gz")
+        and entry["ino"] == stat.st_ino
+        and entry["offset"] <= stat.st_size
+    )
+    if resume:
+        clock = _Clock(datetime.date.fromisoformat(entry["day"]), entry["tod"])
+        entry = dict(entry, blocks=list(entry["blocks"]))
+    else:
+        clock = _Clock(_file_day(path, stat.st_mtime))
+        entry = {"offset": 0, "lines": 0, "blocks": [], "first": None}
+
+    with _open(path) as f:
+        f.seek(entry["offset"])
+        offset = entry["offset"]
+        lines = entry["lines"]
+        for line in f:
+            if not line.endswith(b"\n"):
+                # still being written, picked up by the next update
+                break
+            epoch = clock.tick(line)
+            if entry["first"] is None:
+                entry["first"] = epoch
+            if lines % BLOCK_LINES == 0:
+                entry["blocks"].append([offset, lines, epoch])
+            entry["last"] = epoch
+            offset += len(line)
+            lines += 1
+
+    if not resume and not path.endswith(".gz") and clock.rollovers:
+        # the file ends on the day of its mtime, not starts on it
+        shift = clock.rollovers * 86400
+        clock.day -= datetime.timedelta(days=clock.rollovers)
+        entry["blocks"] = [[o, n, t - shift] for o, n, t in entry["blocks"]]
+        entry["first"] -= shift
+        entry["last"] -= shift
+    entry.update(
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        ino=stat.st_ino,
+        offset=offset,
+        lines=lines,
+        day=clock.day.isoformat(),
+        tod=clock.tod,
+    )
+    return entry
+
+
+def _search_file(
+    path: str,
+    entry: dict,
+    pattern: str,
+    flags: int,
+    since: float | None,
+    until: float | None,
+    limit: int,
+) -> list:
+    regex = re.compile(pattern, flags)
+    block = entry["blocks"][0]
+    if since is not None:
+        for candidate in entry["blocks"]:
+            if candidate[2] > since:
+                break
+            block = candidate
+    offset, line_number, epoch = block
+    clock = _Clock(datetime.date.fromtimestamp(epoch))
+    clock.tod = epoch - clock._midnight
+
+    results = []
+    with _open(path) as f:
+        if not path.endswith(".gz"):
+            f.seek(offset)
+        else:
+            for _ in range(line_number):
+                f.readline()
+        for line in f:
+            if line_number >= entry["lines"]:
+                break
+            epoch = clock.tick(line)
+            line_number += 1
+            if until is not None and epoch > until:
+                break
+            if since is not None and epoch < since:
+                continue
+            text = line.decode(errors="replace").rstrip("\r\n")
+            if regex.search(text):
+                results.append({"line": line_number, "time": epoch, "text": text})
+                if len(results) >= limit:
+                    break
+    return results
+
+
+class LogSearch:
+    """
+    Searches the logs/latest.log and logs/*.log.gz files of instances
+
+    Every logs folder gets an index file (INDEX_FILE) with the time span and
+    line blocks of each log, built and extended in a process pool as logs
+    grow and new archives appear. Searches skip files outside the requested
+    time range, start reading at the block covering its start and scan the
+    files in the process pool too.
+    """
+
+    def __init__(self, workers: int = 2) -> None:
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._index_locks = {}
+
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            return self._pool
+
+    def index(self, logs_dir: str) -> dict:
+        """Updates and returns the index of a logs folder"""
+        with self._lock:
+            lock = self._index_locks.setdefault(logs_dir, threading.Lock())
+        with lock:
+            return self._update_index(logs_dir)
+
+    def _update_index(self, logs_dir: str) -> dict:
+        try:
+            with open(logs_dir + INDEX_FILE, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            index = {}
+
+        files = sorted(
+            file
+            for file in os.listdir(logs_dir)
+            if file.endswith(".log") or file.endswith(".log.gz")
+        )
+        removed = set(index) - set(files)
+        stale = []
+        for file in files:
+            stat = os.stat(logs_dir + file)
+            entry = index.get(file)
+            if (
+                entry is None
+                or entry["size"] != stat.st_size
+                or entry["mtime"] != stat.st_mtime
+            ):
+                stale.append(file)
+        if stale:
+            entries = self._get_pool().map(
+                _index_file,
+                [logs_dir + file for file in stale],
+                [index.get(file) for file in stale],
+            )
+            index.update(zip(stale, entries))
+        index = {file: index[file] for file in files}
+        if stale or removed:
+            with open(logs_dir + INDEX_FILE + ".tmp", "w") as f:
+                json.dump(index, f)
+            os.replace(logs_dir + INDEX_FILE + ".tmp", logs_dir + INDEX_FILE)
+        return index
+
+    def search(
+        self,
+        logs_dirs: dict,
+        query: str,
+        regex: bool = False,
+        ignore_case: bool = True,
+        since: float | None = None,
+        until: float | None = None,
+        limit: int = 1000,
+        on_results=None,
+    ) -> int:
+        """
+        Searches the logs folders in logs_dirs ({server name: folder}) for
+        lines matching query, oldest file first, and passes the matches of
+        each file to on_results(server, file, results). Stops after limit
+        matches, returns the number of matches.
+        """
+        pattern = query if regex else re.escape(query)
+        re.compile(pattern)
+        flags = re.IGNORECASE if ignore_case else 0
+
+        files = []
+        for server, logs_dir in logs_dirs.items():
+            if not os.path.isdir(logs_dir):
+                continue
+            for file, entry in self.index(logs_dir).items():
+                if not entry["lines"]:
+                    continue
+                if since is not None and entry["last"] < since:
+                    continue
+                if until is not None and entry["first"] > until:
+                    continue
+                files.append((entry["first"], server, logs_dir + file, entry))
+        files.sort(key=lambda file: file[0])
+
+        pool = self._get_pool()
+        futures = [
+            (
+                server,
+                os.path.basename(path),
+                pool.submit(
+                    _search_file, path, entry, pattern, flags, since, until, limit
+                ),
+            )
+            for _, server, path, entry in files
+        ]
+        found = 0
+        for server, file, future in futures:
+            if found >= limit:
+                future.cancel()
+                continue
+            results = future.result()[: limit - found]
+            found += len(results)
+            if results and on_results:
+                on_results(server, file, results)
+        return found
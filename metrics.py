@@ -0,0 +1,197 @@
+import http.server
+import os
+import threading
+import time
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class Counters:
+    """Thread-safe monotonically increasing counters with optional labels"""
+
+    def __init__(self) -> None:
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, name: str, **labels) -> float:
+        return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._values.items())
+            ]
+
+
+counters = Counters()
+
+
+def _read_stat(pid: str) -> tuple | None:
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    fields = stat[stat.rindex(")") + 2 :].split()
+    # ppid, utime + stime, threads, starttime, rss
+    return (
+        int(fields[1]),
+        int(fields[11]) + int(fields[12]),
+        int(fields[17]),
+        int(fields[19]),
+        int(fields[21]),
+    )
+
+
+def process_trees(root_pids: list) -> dict:
+    """Returns cpu ticks, threads, rss and start time summed over each root's process tree"""
+    stats = {}
+    children = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        stat = _read_stat(pid)
+        if stat:
+            stats[int(pid)] = stat
+            children.setdefault(stat[0], []).append(int(pid))
+
+    trees = {}
+    for root in root_pids:
+        if root not in stats:
+            continue
+        tree = {"processes": 0, "ticks": 0, "threads": 0, "rss": 0}
+        pending = [root]
+        while pending:
+            pid = pending.pop()
+            _, ticks, threads, _, rss = stats[pid]
+            tree["processes"] += 1
+            tree["ticks"] += ticks
+            tree["threads"] += threads
+            tree["rss"] += rss * PAGE_SIZE
+            pending.extend(children.get(pid, ()))
+        tree["starttime"] = stats[root][3] / CLK_TCK
+        trees[root] = tree
+    return trees
+
+
+def host_stats() -> dict:
+    meminfo = {}
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    with open("/proc/uptime", "r") as f:
+        uptime = float(f.read().split()[0])
+    return {
+        "cpus": os.cpu_count(),
+        "loadavg": os.getloadavg(),
+        "mem_total": meminfo["MemTotal"],
+        "mem_available": meminfo.get("MemAvailable", meminfo["MemFree"]),
+        "uptime": uptime,
+    }
+
+
+class ResourceSampler:
+    """
+    Samples CPU, RSS, thread count and uptime of every running instance's
+    process tree and its console output rate every interval seconds.
+    on_sample is called after every sample.
+    """
+
+    def __init__(self, servers, interval: float = 10, on_sample=None) -> None:
+        self.servers = servers
+        self.interval = interval
+        self.on_sample = on_sample
+        self.instances = {}
+        self._last = {}
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self.sample()
+                if self.on_sample:
+                    self.on_sample()
+            except Exception as e:
+                print(f"Metrics sampling failed: {e}")
+            time.sleep(self.interval)
+
+    def sample(self) -> None:
+        now = time.monotonic()
+        pids = {
+            name: watcher.process.pid for name, watcher in list(self.servers.items())
+        }
+        trees = process_trees(list(pids.values()))
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+
+        instances = {}
+        for name, pid in pids.items():
+            if pid not in trees:
+                continue
+            tree = trees[pid]
+            console_bytes = counters.get("console_bytes_total", server=name)
+            last = self._last.get(name)
+            if last and last[0] == pid:
+                elapsed = now - last[1]
+                cpu = (tree["ticks"] - last[2]) / CLK_TCK / elapsed
+                console_rate = (console_bytes - last[3]) / elapsed
+            else:
+                cpu = console_rate = 0.0
+            self._last[name] = (pid, now, tree["ticks"], console_bytes)
+            instances[name] = {
+                "pid": pid,
+                "processes": tree["processes"],
+                "cpu_percent": round(cpu * 100, 1),
+                "rss": tree["rss"],
+                "threads": tree["threads"],
+                "uptime": round(uptime - tree["starttime"], 1),
+                "console_bytes_per_second": round(console_rate, 1),
+            }
+        self.instances = instances
+
+
+def prometheus_text(snapshot: dict) -> str:
+    lines = []
+    for name, instance in snapshot["instances"].items():
+        for key, value in instance.items():
+            if key != "pid":
+                lines.append(f'stall_instance_{key}{{server="{name}"}} {value}')
+    for key in ("mem_total", "mem_available", "uptime"):
+        lines.append(f"stall_host_{key} {snapshot['host'][key]}")
+    for counter in snapshot["counters"]:
+        labels = ",".join(f'{k}="{v}"' for k, v in counter["labels"].items())
+        labels = "{" + labels + "}" if labels else ""
+        lines.append(f"stall_{counter['name']}{labels} {counter['value']}")
+    for client in snapshot["clients"]:
+        for key in ("messages_sent", "bytes_sent", "dropped"):
+            lines.append(
+                f'stall_client_{key}{{client="{client["address"]}"}} {client[key]}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(port: int, get_text, host: str = "127.0.0.1"):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = get_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
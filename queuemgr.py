@@ -1,39 +1,124 @@
+import collections
 import threading
 import time
+import traceback
+import metrics
 
 
-class QueueManager(list):
+class QueueManager:
     """
     QueueManager
 
-    Item-Syntax: (description           , function                    )
-    e.g.:        ('Printing hello world', lambda: print('Hello world'))
+    Tasks are run by a pool of worker threads. Tasks with the same key (e.g.
+    the server they act on) run one after another in submission order, tasks
+    with different keys or without a key run concurrently.
+
+    Item-Syntax: (description           , function                    [, key ])
+    e.g.:        ('Printing hello world', lambda: print('Hello world'), 'demo')
     """
 
-    def __init__(self, on_change) -> None:
+    def __init__(self, on_change, workers: int = 4) -> None:
         self.on_change = on_change
-        self._queue_thread = threading.Thread(target=self._loop, daemon=True)
-        self._queue_thread.start()
+        self._tasks = []
+        self._busy_keys = set()
+        self._next_id = 1
+        self._stopped = False
+        self.finished = collections.deque(maxlen=50)
+        self._cond = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._loop, daemon=True) for _ in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _next_task(self) -> dict | None:
+        for task in self._tasks:
+            if task["status"] == "queued" and task["key"] not in self._busy_keys:
+                return task
+        return None
 
     def _loop(self) -> None:
         while True:
-            if len(self):
-                if self[0][1] == "break":
-                    break
-                else:
-                    self.on_change()
-                    self[0][1]()
-                del self[0]
-            else:
-                time.sleep(2)
+            with self._cond:
+                while not self._stopped and (task := self._next_task()) is None:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                task["status"] = "running"
+                task["started_at"] = time.time()
+                if task["key"] is not None:
+                    self._busy_keys.add(task["key"])
+            self.on_change()
 
-    def dump(self) -> list:
-        return [task[0] for task in self]
+            try:
+                task["function"]()
+            except Exception:
+                print("Exception occured:\n" + traceback.format_exc())
+            finally:
+                with self._cond:
+                    self._tasks.remove(task)
+                    self._busy_keys.discard(task["key"])
+                    self._cond.notify_all()
+            wait = task["started_at"] - task["queued_at"]
+            run = time.time() - task["started_at"]
+            self.finished.append(
+                {
+                    "id": task["id"],
+                    "description": task["description"],
+                    "wait": round(wait, 3),
+                    "run": round(run, 3),
+                }
+            )
+            metrics.counters.inc("queue_tasks_total")
+            metrics.counters.inc("queue_wait_seconds_total", wait)
+            metrics.counters.inc("queue_run_seconds_total", run)
+            self.on_change()
 
-    def append(self, object) -> None:
-        super().append(object)
+    def append(self, object) -> int:
+        description, function, *key = object
+        with self._cond:
+            task = {
+                "id": self._next_id,
+                "description": description,
+                "function": function,
+                "key": key[0] if key else None,
+                "status": "queued",
+                "queued_at": time.time(),
+            }
+            self._next_id += 1
+            self._tasks.append(task)
+            self._cond.notify()
         self.on_change()
+        return task["id"]
 
-    def __delitem__(self, key, /) -> None:
-        super().__delitem__(key)
+    def cancel(self, task_id: int) -> bool:
+        """Removes a task that has not started yet"""
+        with self._cond:
+            for task in self._tasks:
+                if task["id"] == task_id and task["status"] == "queued":
+                    self._tasks.remove(task)
+                    break
+            else:
+                return False
         self.on_change()
+        return True
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def dump(self) -> list:
+        with self._cond:
+            return [
+                {
+                    "id": task["id"],
+                    "description": task["description"],
+                    "status": task["status"],
+                    "key": task["key"],
+                }
+                for task in self._tasks
+            ]
+
+    def __len__(self) -> int:
+        return len(self._tasks)
@@ -0,0 +1,135 @@
+import os
+import re
+
+CGROUP_ROOT = "/sys/fs/cgroup/andromeda"
+MIN_HEAP_MB = {"forge": 4096, "fabric": 2048}
+# beyond this G1 pauses grow and Minecraft rarely benefits
+MAX_HEAP_MB = 16384
+
+# Aikar's flags, https://docs.papermc.io/paper/aikars-flags
+_G1 = (
+    "-XX:+UseG1GC",
+    "-XX:+ParallelRefProcEnabled",
+    "-XX:MaxGCPauseMillis=200",
+    "-XX:+UnlockExperimentalVMOptions",
+    "-XX:+DisableExplicitGC",
+    "-XX:G1HeapWastePercent=5",
+    "-XX:G1MixedGCCountTarget=4",
+    "-XX:G1MixedGCLiveThresholdPercent=90",
+    "-XX:G1RSetUpdatingPauseTimePercent=5",
+    "-XX:SurvivorRatio=32",
+    "-XX:+PerfDisableSharedMem",
+    "-XX:MaxTenuringThreshold=1",
+)
+_G1_SMALL = (
+    "-XX:G1NewSizePercent=30",
+    "-XX:G1MaxNewSizePercent=40",
+    "-XX:G1HeapRegionSize=8M",
+    "-XX:G1ReservePercent=20",
+    "-XX:InitiatingHeapOccupancyPercent=15",
+)
+_G1_LARGE = (
+    "-XX:G1NewSizePercent=40",
+    "-XX:G1MaxNewSizePercent=50",
+    "-XX:G1HeapRegionSize=16M",
+    "-XX:G1ReservePercent=15",
+    "-XX:InitiatingHeapOccupancyPercent=20",
+)
+_HEAP = re.compile(r"-Xm[sx](\d+)([kKmMgG]?)")
+_UNITS = {"": 1 / 1024**2, "k": 1 / 1024, "m": 1, "g": 1024}
+
+
+def jvm_args(heap_mb: int, commit: bool = True) -> list:
+    """
+    With commit the whole heap is reserved and touched at startup, which is
+    only safe when it fits the host; otherwise the JVM grows it on demand.
+    """
+    return [
+        *((f"-Xms{heap_mb}M", "-XX:+AlwaysPreTouch") if commit else ()),
+        f"-Xmx{heap_mb}M",
+        *_G1,
+        *(_G1_LARGE if heap_mb >= 12288 else _G1_SMALL),
+    ]
+
+
+def heap_mb(args: list) -> int | None:
+    """Returns the maximum heap set in args in MiB"""
+    for arg in args:
+        if arg.startswith("-Xmx") and (match := _HEAP.fullmatch(arg)):
+            return int(int(match[1]) * _UNITS[match[2].lower()])
+    return None
+
+
+def set_heap(args: list, heap_mb: int) -> list:
+    args = [arg for arg in args if not _HEAP.fullmatch(arg)]
+    return [f"-Xms{heap_mb}M", f"-Xmx{heap_mb}M", *args]
+
+
+def plan(
+    mem_total: int, instances: int, software: str, reserve: int = 2 * 1024**3
+) -> dict:
+    """
+    Proposes a heap size, JVM flags and a cgroup memory limit for one of
+    instances servers sharing a host with mem_total bytes, of which reserve
+    bytes are kept for the system.
+
+    If the share of one server is below the minimum heap of its software the
+    host is overcommitted: the minimum heap is proposed anyway, but neither
+    committed at startup nor pre-touched, and overcommitted is set.
+    """
+    budget_mb = max(mem_total - reserve, 0) // max(instances, 1) // 1024**2
+    # the rest is left for metaspace, thread stacks, direct buffers and the JIT
+    heap = min(int(budget_mb * 0.75) // 256 * 256, MAX_HEAP_MB)
+    minimum = MIN_HEAP_MB.get(software.lower(), 1024)
+    overcommitted = heap < minimum
+    heap = max(heap, minimum)
+    return {
+        "heap_mb": heap,
+        "jvm_args": jvm_args(heap, not overcommitted),
+        "memory_max": (heap + max(heap // 4, 512)) * 1024**2,
+        "overcommitted": overcommitted,
+    }
+
+
+def prepare_cgroup(
+    name: str,
+    memory_max: int | None = None,
+    cpu_max: float | None = None,
+    root: str = CGROUP_ROOT,
+) -> str | None:
+    """
+    Creates or updates the cgroup v2 group of an instance and returns its
+    path, None if neither limit is set. cpu_max is in cores.
+    """
+    if not memory_max and not cpu_max:
+        return None
+    os.makedirs(root, exist_ok=True)
+    with open(root + "/cgroup.subtree_control", "w") as f:
+        f.write("+memory +cpu")
+    path = f"{root}/{name}"
+    os.makedirs(path, exist_ok=True)
+    with open(path + "/memory.max", "w") as f:
+        f.write(str(memory_max) if memory_max else "max")
+    with open(path + "/cpu.max", "w") as f:
+        f.write(f"{int(cpu_max * 100000)} 100000" if cpu_max else "max 100000")
+    return path
+
+
+def remove_cgroup(name: str, root: str = CGROUP_ROOT) -> None:
+    try:
+        os.rmdir(f"{root}/{name}")
+    except OSError:
+        pass
+
+
+def preexec(cgroup: str | None = None, cpus: list | None = None):
+    """Returns a function that moves the spawned child into cgroup and pins it to cpus"""
+
+    def apply():
+        if cgroup:
+            with open(cgroup + "/cgroup.procs", "w") as f:
+                f.write("0")
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+
+    return apply
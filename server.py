@@ -1,39 +1,46 @@
 #!/usr/bin/env python3
 import json
-import shutil
+import re
+import signal
+import ssl
 import sys
+import threading
 import os
 import traceback
-from SimpleWebSocketServer import (
-    WebSocket,
-    SimpleSSLWebSocketServer,
-    SimpleWebSocketServer,
-)
+from wsserver import WebSocket, WebSocketServer
 from queuemgr import QueueManager
 from servermgr import ServerManager
-from logger import Logger
+import logger
+import logsearch
+import metrics
 import software_lib
+import wire
 
 d = json.dumps
 
 
 def install_server(mcversion, software, softwareversion, server_name, client):
+    checksum = None
     match software:
         case "Paper":
-            pbd = software_lib.PaperBuildData(mcversion)
+            pbd = paper_versions.build_data(mcversion)
             url = pbd.download_url(softwareversion)
+            checksum = pbd.checksum(softwareversion)
         case "Forge":
             url = forge_versions.download_url(mcversion, softwareversion)
         case "Fabric":
             url = fabric_versions.download_url(mcversion, softwareversion)
         case "Vanilla":
             url = vanilla_versions.download_url(mcversion)
+            checksum = vanilla_versions.checksum(mcversion)
         case _:
             return client.sendMessage(
                 '{"data": "exception", "msg": "cs: invalid server software"}'
             )
 
-    java_versions = software_lib.get_java_versions()
+    java_versions = software_lib.get_java_versions(
+        global_settings.get("jvm_dir", "/usr/lib/jvm")
+    )
     recommended_ver = software_lib.recommended_java_ver(mcversion)
 
     if recommended_ver not in java_versions:
@@ -59,13 +66,17 @@ def install_server(mcversion, software, softwareversion, server_name, client):
                 "mc_version": mcversion,
                 "autostart": False,
             },
+            checksum,
         )
     except Exception as e:
         return client.sendMessage(d({"data": "exception", "msg": f"cs[passed]: {e}"}))
 
 
 def delete_server(name, client):
-    shutil.rmtree(servers.instance_folder + name)
+    try:
+        servers.delete_server(name)
+    except Exception as e:
+        return client.sendMessage(d({"data": "exception", "msg": f"delete: {e}"}))
     client.sendMessage(
         d(
             {
@@ -78,6 +89,132 @@ def delete_server(name, client):
     )
 
 
+def backup_server(name, client):
+    try:
+        backup = servers.backup_server(name, global_settings.get("backup_keep", 0))
+    except Exception as e:
+        return client.sendMessage(d({"data": "exception", "msg": f"backup: {e}"}))
+    client.sendMessage(d({"data": "backupdone", "server": name, "backup": backup}))
+
+
+def restore_server(name, backup_id, client):
+    try:
+        servers.restore_server(name, backup_id)
+    except Exception as e:
+        return client.sendMessage(d({"data": "exception", "msg": f"restore: {e}"}))
+    client.sendMessage(d({"data": "restoredone", "server": name, "backup": backup_id}))
+
+
+def search_logs(names, json_data, client):
+    search_id = json_data.get("search_id")
+    page_size = json_data.get("page_size", 100)
+    page = []
+
+    def send_page(done, found=None):
+        message = {"data": "searchresults", "search_id": search_id}
+        message.update(results=list(page), done=done)
+        if found is not None:
+            message["found"] = found
+        client.sendMessage(d(message))
+        page.clear()
+
+    def on_results(server, file, results):
+        for result in results:
+            page.append({"server": server, "file": file, **result})
+            if len(page) >= page_size:
+                send_page(False)
+
+    try:
+        found = log_search.search(
+            {name: servers.instance_folder + name + "/logs/" for name in names},
+            json_data["query"],
+            json_data.get("regex", False),
+            json_data.get("ignore_case", True),
+            json_data.get("since"),
+            json_data.get("until"),
+            min(json_data.get("limit", 1000), 10000),
+            on_results,
+        )
+    except re.error as e:
+        return client.sendMessage(
+            d({"data": "exception", "msg": f"searchlogs: invalid pattern: {e}"})
+        )
+    except Exception as e:
+        print("Exception occured:\n" + traceback.format_exc())
+        return client.sendMessage(d({"data": "exception", "msg": f"searchlogs: {e}"}))
+    send_page(True, found)
+
+
+def bulk_progress(action, total):
+    done = []
+
+    def on_progress(name, result):
+        done.append(name)
+        for client in authed_clients:
+            client.sendMessage(
+                d(
+                    {
+                        "data": "bulkprogress",
+                        "action": action,
+                        "server": name,
+                        "result": result,
+                        "done": len(done),
+                        "total": total,
+                    }
+                )
+            )
+
+    return on_progress
+
+
+def stop_server(name):
+    return servers.stop_server(
+        name,
+        global_settings.get("stop_timeout", 60),
+        global_settings.get("kill_timeout", 10),
+    )
+
+
+def queue_bulk(action, description, function):
+    """
+    Queues function(name) for every server under its own queue key, so bulk
+    operations are ordered with everything else queued for that server
+    """
+    names = sorted(
+        servers.list_servers().items(),
+        key=lambda item: (-item[1].get("autostart_priority", 0), item[0]),
+    )
+    on_progress = bulk_progress(action, len(names))
+
+    def task(name):
+        try:
+            result = function(name)
+        except Exception:
+            on_progress(name, "failed")
+            raise
+        on_progress(name, result)
+
+    for name, _ in names:
+        queue.append((description + name, lambda name=name: task(name), name))
+
+
+def stop_all():
+    queue_bulk("stopall", "Stopping server: ", stop_server)
+
+
+def start_all():
+    queue_bulk(
+        "startall",
+        "Starting server: ",
+        lambda name: "started" if servers.start_server(name) else "running",
+    )
+
+
+def restart_server(name):
+    stop_server(name)
+    servers.start_server(name)
+
+
 class WebSocketHandler(WebSocket):
     def handleConnected(self):
         global_logger.log(f"{self.address[0]} CONNECTED")
@@ -86,18 +223,26 @@ class WebSocketHandler(WebSocket):
         if self in authed_clients:
             authed_clients.remove(self)
         for server in servers.logging_websockets.keys():
-            servers.logging_websockets[server].remove(self)
+            if self in servers.logging_websockets[server]:
+                servers.logging_websockets[server].remove(self)
         global_logger.log(f"{self.address[0]} DISCONNECTED")
 
     def handleMessage(self):
-        global_logger.log(f"{self.address[0]} MESSAGE: {self.data}")
         try:
-            json_data = json.loads(self.data)
-        except json.JSONDecodeError:
+            json_data = wire.decode(self.data)
+        except ValueError:
+            global_logger.log(
+                f"{self.address[0]} MESSAGE: {global_logger.payload(self.data)}"
+            )
             return self.sendMessage(
                 '{"data": "exception", "msg": "json parsing error"}'
             )
 
+        global_logger.log(
+            f"{self.address[0]} MESSAGE: {global_logger.payload(json_data)}",
+            logger.DEBUG if json_data.get("data") == "console_write" else logger.INFO,
+        )
+
         if json_data["data"] != "auth" and self not in authed_clients:
             return self.sendMessage('{"data": "exception", "msg": "not authed"}')
 
@@ -105,30 +250,94 @@ class WebSocketHandler(WebSocket):
             match json_data["data"]:
                 case "auth":
                     if json_data["hash"] == global_settings["authhash"]:
-                        authed_clients.append(self)
-                        return self.sendMessage('{"data": "welcome"}')
+                        encoding = json_data.get("encoding", "json")
+                        if encoding not in wire.ENCODINGS:
+                            return self.sendMessage(
+                                '{"data": "exception", "msg": "unsupported encoding"}'
+                            )
+                        self.encoding = encoding
+                        if self not in authed_clients:
+                            authed_clients.append(self)
+                        return self.sendMessage(
+                            {"data": "welcome", "encoding": encoding}
+                        )
                     else:
                         return self.sendMessage(
                             '{"data": "exception", "msg": "invalid login"}'
                         )
 
                 case "startconsolelogging":
-                    if json_data["server_name"] not in servers.list_servers():
+                    if not servers.server_exists(json_data["server_name"]):
                         return self.sendMessage(
                             '{"data": "exception", "msg": "invalid server name"}'
                         )
-                    if json_data["server_name"] not in logging_websockets:
-                        logging_websockets[json_data["server_name"]] = []
-                    logging_websockets[json_data["server_name"]].append(self)
-                    if json_data["server_name"] in servers:
-                        history = servers[json_data["server_name"]].console_history
+                    name = json_data["server_name"]
+                    if name not in logging_websockets:
+                        logging_websockets[name] = []
+                    if self not in logging_websockets[name]:
+                        logging_websockets[name].append(self)
+                    history = servers.history(name)
+                    if history is None:
+                        return self.sendMessage(
+                            d(
+                                {
+                                    "data": "log_history",
+                                    "console": name,
+                                    "log": "*** server is not running ***",
+                                    "start": 0,
+                                    "end": 0,
+                                    "truncated": False,
+                                }
+                            )
+                        )
+                    if "since_time" in json_data:
+                        since = history.offset_at(json_data["since_time"])
                     else:
-                        history = "*** server is not running ***"
+                        since = json_data.get("since", 0)
+                    start, end, log = history.read(
+                        max(
+                            since,
+                            history.end
+                            - min(json_data.get("limit", 1024 * 1024), 16 * 1024**2),
+                        )
+                    )
                     return self.sendMessage(
                         d(
                             {
                                 "data": "log_history",
-                                "log": history,
+                                "console": name,
+                                "log": log,
+                                "start": start,
+                                "end": end,
+                                "truncated": start > since,
+                            }
+                        )
+                    )
+
+                case "getconsolehistory":
+                    name = json_data["server_name"]
+                    if not servers.server_exists(name):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    history = servers.history(name)
+                    if history is None:
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "no console history"}'
+                        )
+                    start, end, log = history.page(
+                        json_data.get("before", history.end),
+                        min(json_data.get("limit", 64 * 1024), 1024 * 1024),
+                    )
+                    return self.sendMessage(
+                        d(
+                            {
+                                "data": "console_page",
+                                "console": name,
+                                "log": log,
+                                "start": start,
+                                "end": end,
+                                "more": start > history.start,
                             }
                         )
                     )
@@ -139,7 +348,7 @@ class WebSocketHandler(WebSocket):
                             logging_websockets[server].remove(self)
 
                 case "startserver":
-                    if json_data["server_name"] not in servers.list_servers():
+                    if not servers.server_exists(json_data["server_name"]):
                         return self.sendMessage(
                             '{"data": "exception", "msg": "invalid server name"}'
                         )
@@ -147,12 +356,13 @@ class WebSocketHandler(WebSocket):
                         (
                             f"Starting {json_data['server_name']}...",
                             lambda: servers.start_server(json_data["server_name"]),
+                            json_data["server_name"],
                         )
                     )
 
                 case "stopserver":
                     name = json_data["server_name"]
-                    if servers.server_states()[name] != "running":
+                    if servers.server_state(name) != "running":
                         return self.sendMessage(
                             '{"data": "exception", "msg": "server not running"}'
                         )
@@ -160,6 +370,27 @@ class WebSocketHandler(WebSocket):
                         (
                             "Stopping server: " + name,
                             lambda: servers[name].write("stop\n"),
+                            name,
+                        )
+                    )
+
+                case "stopall":
+                    stop_all()
+
+                case "startall":
+                    start_all()
+
+                case "restart":
+                    name = json_data["server_name"]
+                    if not servers.server_exists(name):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    queue.append(
+                        (
+                            "Restarting server: " + name,
+                            lambda: restart_server(name),
+                            name,
                         )
                     )
 
@@ -181,9 +412,7 @@ class WebSocketHandler(WebSocket):
                             {
                                 "data": "serverstate",
                                 "server": json_data["server_name"],
-                                "state": servers.server_states()[
-                                    json_data["server_name"]
-                                ],
+                                "state": servers.server_state(json_data["server_name"]),
                             }
                         )
                     )
@@ -211,7 +440,7 @@ class WebSocketHandler(WebSocket):
                     }
                     match json_data["software"]:
                         case "Paper":
-                            pbd = software_lib.PaperBuildData(json_data["mc_version"])
+                            pbd = paper_versions.build_data(json_data["mc_version"])
                             rt["builds"] = pbd.builds()
                         case "Fabric":
                             rt["builds"] = fabric_versions.fabric_versions()
@@ -241,12 +470,13 @@ class WebSocketHandler(WebSocket):
                             lambda: install_server(
                                 mcversion, software, softwareversion, name, self
                             ),
+                            name,
                         )
                     )
 
                 case "deleteserver":
                     name = json_data["name"]
-                    if servers.server_states()[name] != "stopped":
+                    if servers.server_state(name) != "stopped":
                         return self.sendMessage(
                             '{"data": "exception", "msg": "delete: server is running"}'
                         )
@@ -255,9 +485,121 @@ class WebSocketHandler(WebSocket):
                             (
                                 "Deleting server: " + name,
                                 lambda: delete_server(name, self),
+                                name,
                             )
                         )
 
+                case "setautostart":
+                    if not servers.server_exists(json_data["server_name"]):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    changes = {"autostart": bool(json_data["autostart"])}
+                    if "priority" in json_data:
+                        changes["autostart_priority"] = int(json_data["priority"])
+                    return self.sendMessage(
+                        d(
+                            {
+                                "data": "serversettings",
+                                "server": json_data["server_name"],
+                                "settings": servers.update_settings(
+                                    json_data["server_name"], changes
+                                ),
+                            }
+                        )
+                    )
+
+                case "getresources" | "setresources":
+                    name = json_data["server_name"]
+                    if not servers.server_exists(name):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    if json_data["data"] == "getresources":
+                        rt = servers.get_resources(name)
+                    else:
+                        rt = servers.set_resources(name, json_data["resources"])
+                    return self.sendMessage(
+                        d({"data": "resources", "server": name, **rt})
+                    )
+
+                case "backupserver":
+                    name = json_data["server_name"]
+                    if not servers.server_exists(name):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    queue.append(
+                        (
+                            "Backing up server: " + name,
+                            lambda: backup_server(name, self),
+                            name,
+                        )
+                    )
+
+                case "listbackups":
+                    name = json_data["server_name"]
+                    if not servers.server_exists(name):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    return self.sendMessage(
+                        d(
+                            {
+                                "data": "backuplist",
+                                "server": name,
+                                "backups": servers.backups.list(name),
+                            }
+                        )
+                    )
+
+                case "restorebackup":
+                    name = json_data["server_name"]
+                    backup_id = json_data["backup"]
+                    if not servers.server_exists(name):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "invalid server name"}'
+                        )
+                    if backup_id not in [
+                        backup["id"] for backup in servers.backups.list(name)
+                    ]:
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "restore: invalid backup"}'
+                        )
+                    if servers.server_state(name) != "stopped":
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "restore: server is running"}'
+                        )
+                    queue.append(
+                        (
+                            f"Restoring backup {backup_id} of server: {name}",
+                            lambda: restore_server(name, backup_id, self),
+                            name,
+                        )
+                    )
+
+                case "searchlogs":
+                    if "server_name" in json_data:
+                        if not servers.server_exists(json_data["server_name"]):
+                            return self.sendMessage(
+                                '{"data": "exception", "msg": "invalid server name"}'
+                            )
+                        names = [json_data["server_name"]]
+                    else:
+                        names = list(servers.list_servers())
+                    threading.Thread(
+                        target=search_logs, args=(names, json_data, self), daemon=True
+                    ).start()
+
+                case "cancelqueuetask":
+                    if not queue.cancel(json_data["task_id"]):
+                        return self.sendMessage(
+                            '{"data": "exception", "msg": "task not cancellable"}'
+                        )
+
+                case "getmetrics":
+                    return self.sendMessage({"data": "metrics", **collect_metrics()})
+
                 case "console_write":
                     if json_data["server_name"] not in servers:
                         return self.sendMessage(
@@ -269,6 +611,10 @@ class WebSocketHandler(WebSocket):
                     return self.sendMessage(
                         '{"data": "exception", "msg": "invalid command"}'
                     )
+        except software_lib.requests.RequestException as e:
+            return self.sendMessage(
+                d({"data": "exception", "msg": f"software catalog unavailable: {e}"})
+            )
         except KeyError:
             print("Exception occured:\n" + traceback.format_exc())
             return self.sendMessage(
@@ -276,51 +622,154 @@ class WebSocketHandler(WebSocket):
                     {
                         "data": "exception",
                         "msg": "missing data",
-                        "old_message": self.data,
+                        "old_message": json_data,
                     }
                 )
             )
 
 
+def collect_metrics() -> dict:
+    return {
+        "instances": sampler.instances,
+        "host": metrics.host_stats(),
+        "counters": metrics.counters.snapshot(),
+        "queue": list(queue.finished),
+        "clients": [
+            {
+                "address": f"{client.address[0]}:{client.address[1]}",
+                "messages_sent": client.messages_sent,
+                "bytes_sent": client.bytes_sent,
+                "dropped": client.dropped,
+            }
+            for client in list(socketserver.clients)
+        ],
+    }
+
+
+def write_metrics_file():
+    if "metrics_file" not in global_settings:
+        return
+    with open(global_settings["metrics_file"] + ".tmp", "w") as f:
+        f.write(metrics.prometheus_text(collect_metrics()))
+    os.replace(
+        global_settings["metrics_file"] + ".tmp", global_settings["metrics_file"]
+    )
+
+
 def on_queue_change():
     for client in authed_clients:
         client.sendMessage(d({"data": "queue", "queue": queue.dump()}))
 
 
-os.makedirs("/var/andromeda/log", exist_ok=True)
+with open(
+    os.environ.get(
+        "ANDROMEDA_SETTINGS", "/var/andromeda/global_settings.andromeda.json"
+    ),
+    "r",
+) as f:
+    global_settings = json.load(f)
+
+log_settings = {
+    "level": logger.LEVELS[global_settings.get("log_level", "info")],
+    "max_bytes": global_settings.get("log_max_bytes", 10 * 1024**2),
+    "max_age": global_settings.get("log_max_age"),
+    "backups": global_settings.get("log_backups", 5),
+    "max_payload": global_settings.get("log_max_payload", 512),
+}
 if len(sys.argv) >= 2 and sys.argv[1] == "dbg":
     print("Using debugging log")
-    global_logger = Logger("stall.log")
+    global_logger = logger.Logger("stall.log", **log_settings)
 else:
-    global_logger = Logger("/var/andromeda/stall.log")
+    os.makedirs("/var/andromeda/log", exist_ok=True)
+    global_logger = logger.Logger("/var/andromeda/stall.log", **log_settings)
 global_logger.log("Welcome to Andromeda-Stall!")
 
-queue = QueueManager(on_queue_change)
-servers = ServerManager()
+queue = QueueManager(on_queue_change, global_settings.get("queue_workers", 4))
+servers = ServerManager(
+    global_settings.get("instance_folder", "/var/andromeda/instances/"),
+    global_settings.get("artifact_folder", "/var/andromeda/artifacts/"),
+    global_settings.get("memory_reserve", 2 * 1024**3),
+    global_settings.get("cgroup_root", "/sys/fs/cgroup/andromeda"),
+    global_settings.get("delete_rate", 2000),
+    global_settings.get("backup_folder", "/var/andromeda/backups/"),
+)
 logging_websockets = servers.logging_websockets
 authed_clients = servers.authed_clients
-vanilla_versions = software_lib.VanillaData()
-paper_versions = software_lib.PaperData()
-fabric_versions = software_lib.FabricData()
-forge_versions = software_lib.ForgeData()
-
-with open("/var/andromeda/global_settings.andromeda.json", "r") as f:
-    global_settings = json.load(f)
+software_api = global_settings.get("software_api", {})
+cache_folder = global_settings.get("cache_folder", software_lib.CACHE_DIR)
+vanilla_versions = software_lib.VanillaData(
+    cache_dir=cache_folder, **software_api.get("vanilla", {})
+)
+paper_versions = software_lib.PaperData(
+    cache_dir=cache_folder, **software_api.get("paper", {})
+)
+fabric_versions = software_lib.FabricData(
+    cache_dir=cache_folder, **software_api.get("fabric", {})
+)
+forge_versions = software_lib.ForgeData(
+    cache_dir=cache_folder, **software_api.get("forge", {})
+)
+software_lib.refresh_catalogs(
+    [vanilla_versions, paper_versions, fabric_versions, forge_versions],
+    on_error=lambda url, e: global_logger.log(
+        f"Catalog refresh failed: {url}: {e}", logger.WARNING
+    ),
+)
 
 if global_settings["ssl"]:
-    socketserver = SimpleSSLWebSocketServer(
-        "0.0.0.0",
-        29836,
-        WebSocketHandler,
-        global_settings["certfile"],
-        global_settings["keyfile"],
-    )
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(global_settings["certfile"], global_settings["keyfile"])
 else:
-    socketserver = SimpleWebSocketServer("0.0.0.0", 29836, WebSocketHandler)
+    ssl_context = None
+log_search = logsearch.LogSearch(global_settings.get("search_workers", 2))
+socketserver = WebSocketServer(
+    global_settings.get("host", "0.0.0.0"),
+    global_settings.get("port", 29836),
+    WebSocketHandler,
+    ssl_context,
+    global_settings.get("client_queue_size", 1024),
+    global_settings.get("client_console_backlog", 256),
+    "deflate" if global_settings.get("compression", True) else None,
+)
+sampler = metrics.ResourceSampler(
+    servers, global_settings.get("metrics_interval", 10), write_metrics_file
+)
+if "metrics_port" in global_settings:
+    metrics.serve_prometheus(
+        global_settings["metrics_port"],
+        lambda: metrics.prometheus_text(collect_metrics()),
+    )
+
+
+def autostart():
+    started = servers.autostart(
+        global_settings.get("autostart_concurrency", 2),
+        global_settings.get("autostart_timeout", 300),
+    )
+    global_logger.log(f"Autostarted {len(started)} servers: {', '.join(started)}")
+
+
+threading.Thread(target=autostart, daemon=True).start()
 global_logger.log("Server is ready")
+signal.signal(signal.SIGTERM, lambda signum, frame: socketserver.close())
 try:
     socketserver.serveforever()
 except KeyboardInterrupt:
     socketserver.close()
+queue.stop()
+if len(servers):
+    global_logger.log(f"Stopping {len(servers)} servers")
+    results = servers.stop_servers(
+        None,
+        global_settings.get("stop_timeout", 60),
+        global_settings.get("kill_timeout", 10),
+    )
+    global_logger.log(
+        "Stopped servers: "
+        + ", ".join(f"{name} ({result})" for name, result in results.items())
+    )
+for history in list(servers.histories.values()):
+    history.close()
 global_logger.log("Andromeda-Stall stopped")
+global_logger.close()
 exit()
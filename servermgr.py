@@ -1,8 +1,21 @@
+import concurrent.futures
 import os
 import json
+import shutil
+import signal
 import subprocess
-import software_lib
+import threading
+import time
+import traceback
+import artifacts
+import backups
+import consoleparser
+import fanout
+import metrics
+import resources
+import trash
 import vconsole
+import wire
 
 # settings:
 #
@@ -13,6 +26,12 @@ import vconsole
 #   software_version : Version or build of the server software. Empty if vanilla
 #   mc_version : Minecraft version
 #   autostart : Automatically start this mc server when andromeda_stall starts
+#   autostart_priority : (optional) Servers with a higher priority are autostarted first
+#   console_history_bytes : (optional) Console scrollback kept on disk in logs/console/, in bytes
+#   console_history_lines : (optional) Console scrollback kept on disk, in lines. 0 for no limit
+#   memory_max : (optional) cgroup memory limit of the server, in bytes
+#   cpu_max : (optional) cgroup CPU limit of the server, in cores
+#   cpus : (optional) CPUs the server is pinned to
 # }
 
 
@@ -24,11 +43,41 @@ class ServerManager(dict):
     def __init__(
         self,
         instance_folder: str = "/var/andromeda/instances/",
+        artifact_folder: str = "/var/andromeda/artifacts/",
+        memory_reserve: int = 2 * 1024**3,
+        cgroup_root: str = resources.CGROUP_ROOT,
+        delete_rate: int = 2000,
+        backup_folder: str = "/var/andromeda/backups/",
     ) -> None:
         self.instance_folder = instance_folder
+        self.memory_reserve = memory_reserve
+        self.cgroup_root = cgroup_root
+        self.artifacts = artifacts.ArtifactStore(artifact_folder)
         self.logging_websockets = {}
         self._server_states = {}
+        self._state_changed = threading.Condition()
+        self._event_waiters = {}
+        self.histories = {}
+        self.parsers = {}
         self.authed_clients = []
+        self.inventory_ttl = 2.0
+        self._inventory = {}
+        self._instance_dirs = []
+        self._settings_mtimes = {}
+        self._folder_mtime = None
+        self._inventory_checked = 0.0
+        self._inventory_lock = threading.Lock()
+        self._server_locks = {}
+        self.console_fanout = fanout.ConsoleFanout(self.logging_websockets)
+        self.trash = trash.Trash(
+            instance_folder + ".trash/", self._on_delete_progress, delete_rate
+        )
+        self.backups = backups.BackupStore(backup_folder)
+
+    def _broadcast(self, message: dict) -> None:
+        frame = wire.Frame(message)
+        for client in self.authed_clients:
+            client.sendMessage(frame)
 
     def create_server(
         self,
@@ -37,28 +86,47 @@ class ServerManager(dict):
         download_url: str,
         java_bin: str,
         settings: dict,
+        checksum: tuple | None = None,
     ) -> None:
         install_dir = self.instance_folder + name + "/"
         os.makedirs(install_dir, exist_ok=True)
-        response = software_lib.requests.get(download_url)
-        if response.status_code != 200:
-            raise Exception("failed downloading server")
+        artifact_key = "/".join(
+            (
+                software,
+                settings.get("mc_version", ""),
+                str(settings.get("software_version", "")),
+            )
+        )
+
+        def on_progress(received, total):
+            self._broadcast(
+                {
+                    "data": "downloadprogress",
+                    "server": name,
+                    "received": received,
+                    "total": total,
+                }
+            )
 
         if software == "Forge":
-            with open("/tmp/andromeda-forge.jar", "wb") as f:
-                f.write(response.content)
+            installer = f"/tmp/andromeda-forge-{name}.jar"
+            self.artifacts.fetch(
+                artifact_key, download_url, installer, checksum, on_progress
+            )
 
             subprocess.run(
                 (
                     java_bin,
                     "-jar",
-                    "/tmp/andromeda-forge.jar",
+                    installer,
                     "-installServer",
                     install_dir,
                 )
             )
 
-            os.remove("andromeda-forge.jar.log")
+            os.remove(installer)
+            if os.path.exists(os.path.basename(installer) + ".log"):
+                os.remove(os.path.basename(installer) + ".log")
 
             if not os.path.exists(install_dir + "run.sh"):
                 os.rmdir(install_dir)
@@ -68,12 +136,17 @@ class ServerManager(dict):
                 content = f.read().replace("java", java_bin).replace("$@", "nogui")
                 f.write(content)
         elif software in ("Paper", "Fabric", "Vanilla"):
-            with open(install_dir + "server.jar", "wb") as f:
-                f.write(response.content)
+            self.artifacts.fetch(
+                artifact_key,
+                download_url,
+                install_dir + "server.jar",
+                checksum,
+                on_progress,
+            )
 
             with open(install_dir + "run.sh", "w") as f:
                 f.write(
-                    f"#!/usr/bin/env sh\n{java_bin} -jar server.jar @user_jvm_args.txt nogui"
+                    f"#!/usr/bin/env sh\n{java_bin} @user_jvm_args.txt -jar server.jar nogui"
                 )
         else:
             raise SyntaxError("invalid server software")
@@ -81,87 +154,491 @@ class ServerManager(dict):
         with open(install_dir + "eula.txt", "w") as f:
             f.write("eula=true")
 
-        with open(install_dir + "user_jvm_args.txt", "w") as f:
-            f.write("-Xmx4G")
+        instances = len(self.list_servers()) + (not self.server_exists(name))
+        plan = self.plan_resources(software, instances)
+        if plan["overcommitted"]:
+            print(
+                f"Not enough memory for {instances} servers, {name} gets "
+                f"{plan['heap_mb']} MiB of heap committed on demand"
+            )
+        self._write_jvm_args(name, plan["jvm_args"])
         os.system('chmod +x "' + install_dir + '"/run.sh')
 
         instance_settings = {"software": software, "java": java_bin, **settings}
         with open(install_dir + "settings.andromeda.json", "w") as f:
             json.dump(instance_settings, f)
+        self._store_inventory(name, instance_settings)
 
-        for client in self.authed_clients:
-            client.sendMessage(
-                json.dumps(
-                    {
-                        "data": "serverlist",
-                        "servers": self.list_servers(),
-                        "states": self.server_states(),
-                    }
-                )
-            )
+        self._broadcast(
+            {
+                "data": "serverlist",
+                "servers": self.list_servers(),
+                "states": self.server_states(),
+            }
+        )
+
+    def _refresh_inventory(self, force: bool = False) -> None:
+        with self._inventory_lock:
+            now = time.monotonic()
+            if not force and now - self._inventory_checked < self.inventory_ttl:
+                return
+            self._inventory_checked = now
+
+            folder_mtime = os.stat(self.instance_folder).st_mtime_ns
+            if force or folder_mtime != self._folder_mtime:
+                self._folder_mtime = folder_mtime
+                self._instance_dirs = os.listdir(self.instance_folder)
+
+            inventory = {}
+            for dirname in self._instance_dirs:
+                if dirname.startswith("."):
+                    continue
+                path = self.instance_folder + dirname + "/settings.andromeda.json"
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                if (
+                    dirname in self._inventory
+                    and self._settings_mtimes.get(dirname) == mtime
+                ):
+                    inventory[dirname] = self._inventory[dirname]
+                    continue
+                with open(path, "r") as f:
+                    inventory[dirname] = json.load(f)
+                self._settings_mtimes[dirname] = mtime
+            self._inventory = inventory
+
+    def _store_inventory(self, name: str, settings: dict) -> None:
+        with self._inventory_lock:
+            self._inventory[name] = settings
+            self._settings_mtimes[name] = os.stat(
+                self.instance_folder + name + "/settings.andromeda.json"
+            ).st_mtime_ns
+            if name not in self._instance_dirs:
+                self._instance_dirs.append(name)
+
+    def _forget_inventory(self, name: str) -> None:
+        with self._inventory_lock:
+            self._inventory.pop(name, None)
+            self._settings_mtimes.pop(name, None)
+            if name in self._instance_dirs:
+                self._instance_dirs.remove(name)
+        self._server_states.pop(name, None)
+        history = self.histories.pop(name, None)
+        if history is not None:
+            history.close()
+        self.parsers.pop(name, None)
 
     def list_servers(self) -> dict:
-        servers = {}
-        for dirname in os.listdir(self.instance_folder):
-            if not os.path.exists(
-                self.instance_folder + dirname + "/settings.andromeda.json"
-            ):
-                continue
-            servers[dirname] = self.get_settings(dirname)
-        return servers
+        self._refresh_inventory()
+        return dict(self._inventory)
+
+    def server_exists(self, name: str) -> bool:
+        self._refresh_inventory()
+        return name in self._inventory
 
     def get_settings(self, name: str) -> dict:
+        self._refresh_inventory()
+        if name in self._inventory:
+            return dict(self._inventory[name])
         with open(self.instance_folder + name + "/settings.andromeda.json", "r") as f:
             return json.load(f)
 
-    def handle_output(self, server_name: str, output: str) -> None:
-        if output == "*** process stopped ***":
-            del self[server_name]
+    def update_settings(self, name: str, changes: dict) -> dict:
+        settings = {**self.get_settings(name), **changes}
+        path = self.instance_folder + name + "/settings.andromeda.json"
+        with open(path + ".tmp", "w") as f:
+            json.dump(settings, f)
+        os.replace(path + ".tmp", path)
+        self._store_inventory(name, settings)
+        return settings
 
-        if server_name not in self:
-            self._server_states[server_name] = "stopped"
-        elif "Stopping server" in output:
-            self._server_states[server_name] = "stopping"
-        elif "Time elapsed:" in output:
-            self._server_states[server_name] = "running"
+    def plan_resources(self, software: str, instances: int | None = None) -> dict:
+        if instances is None:
+            instances = len(self.list_servers())
+        return resources.plan(
+            metrics.host_stats()["mem_total"],
+            instances,
+            software,
+            self.memory_reserve,
+        )
 
-        for client in self.authed_clients:
-            client.sendMessage(
-                json.dumps(
-                    {
-                        "data": "serverstate",
-                        "server": server_name,
-                        "state": self.server_states()[server_name],
-                    }
-                )
+    def _read_jvm_args(self, name: str) -> list:
+        try:
+            with open(self.instance_folder + name + "/user_jvm_args.txt", "r") as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    def _write_jvm_args(self, name: str, args: list) -> None:
+        with open(self.instance_folder + name + "/user_jvm_args.txt", "w") as f:
+            f.write("\n".join(args) + "\n")
+
+    def _fix_run_script(self, name: str) -> None:
+        """
+        Older installs passed @user_jvm_args.txt after -jar, where java hands
+        it to the server instead of expanding it
+        """
+        path = self.instance_folder + name + "/run.sh"
+        try:
+            with open(path, "r") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        old = "-jar server.jar @user_jvm_args.txt"
+        if old in content:
+            with open(path, "w") as f:
+                f.write(content.replace(old, "@user_jvm_args.txt -jar server.jar"))
+
+    def get_resources(self, name: str) -> dict:
+        settings = self.get_settings(name)
+        args = self._read_jvm_args(name)
+        return {
+            "heap_mb": resources.heap_mb(args),
+            "jvm_args": args,
+            "memory_max": settings.get("memory_max"),
+            "cpu_max": settings.get("cpu_max"),
+            "cpus": settings.get("cpus"),
+            "proposal": self.plan_resources(settings.get("software", "vanilla")),
+        }
+
+    def set_resources(self, name: str, changes: dict) -> dict:
+        """
+        Updates heap_mb, jvm_args, memory_max, cpu_max and cpus of a server.
+        Changes take effect on the next start.
+        """
+        if "jvm_args" in changes:
+            self._write_jvm_args(name, changes["jvm_args"])
+        if "heap_mb" in changes:
+            self._write_jvm_args(
+                name, resources.set_heap(self._read_jvm_args(name), changes["heap_mb"])
             )
+        self.update_settings(
+            name,
+            {
+                key: changes[key]
+                for key in ("memory_max", "cpu_max", "cpus")
+                if key in changes
+            },
+        )
+        return self.get_resources(name)
 
-        if server_name in self.logging_websockets:
-            for client in self.logging_websockets[server_name]:
-                client.sendMessage(
-                    json.dumps(
-                        {
-                            "data": "console_logging",
-                            "console": server_name,
-                            "msg": output,
-                        }
-                    )
-                )
+    def _on_delete_progress(self, name: str, progress: dict) -> None:
+        if name.startswith("."):
+            return
+        self._broadcast({"data": "deleteprogress", "server": name, **progress})
+
+    def delete_server(self, name: str) -> None:
+        """Moves the server to the trash, its files are removed in the background"""
+        with self.server_lock(name):
+            if name in self:
+                raise RuntimeError("server is running")
+            self.trash.move(self.instance_folder + name, name)
+            resources.remove_cgroup(name, self.cgroup_root)
+            self._forget_inventory(name)
 
-    def start_server(self, name: str) -> None:
+    def _set_state(self, server_name: str, state: str) -> None:
+        with self._state_changed:
+            if self._server_states.get(server_name) == state:
+                return
+            self._server_states[server_name] = state
+            self._state_changed.notify_all()
+        self._broadcast(
+            {
+                "data": "serverstate",
+                "server": server_name,
+                "state": state,
+            }
+        )
+
+    def handle_output(self, server_name: str, output: str) -> None:
+        stopped = output == "*** process stopped ***"
+        if stopped:
+            self.pop(server_name, None)
+            self._set_state(server_name, "stopped")
+            with self._state_changed:
+                for _, waiter in self._event_waiters.pop(server_name, ()):
+                    waiter.set()
+        else:
+            for event in self.parsers[server_name].feed(output):
+                self.handle_event(server_name, event)
+
+        size = len(output.encode())
+        metrics.counters.inc("console_bytes_total", size, server=server_name)
+        end = self.histories[server_name].end
+        self.console_fanout.push(server_name, output, end - size, end)
+        if stopped:
+            self.console_fanout.flush(server_name)
+
+    def handle_event(self, server_name: str, event: dict) -> None:
+        match event["event"]:
+            case "ready":
+                self._set_state(server_name, "running")
+            case "stopping":
+                self._set_state(server_name, "stopping")
+        with self._state_changed:
+            waiters = self._event_waiters.get(server_name, [])
+            for waiter in [w for w in waiters if w[0] == event["event"]]:
+                waiter[1].set()
+                waiters.remove(waiter)
+        metrics.counters.inc(
+            "console_events_total", server=server_name, event=event["event"]
+        )
+        self._broadcast({"data": "serverevent", "server": server_name, **event})
+
+    def expect_event(self, server_name: str, event: str) -> threading.Event:
+        """
+        Returns a threading.Event that is set the next time the server emits
+        event, or when it stops
+        """
+        waiter = threading.Event()
+        with self._state_changed:
+            self._event_waiters.setdefault(server_name, []).append((event, waiter))
+        return waiter
+
+    def backup_server(self, name: str, keep: int = 0, timeout: float = 120) -> dict:
+        """
+        Backs up a server. A running server is told to flush the world to
+        disk and to stop saving until the backup is done.
+        """
+        watcher = self.get(name)
+        if watcher is None:
+            return self.backups.create(name, self.instance_folder + name, keep)
+
+        saved = self.expect_event(name, "saved")
+        try:
+            watcher.write("save-off\n")
+            watcher.write("save-all flush\n")
+            if not saved.wait(timeout):
+                raise TimeoutError("server did not finish saving")
+            return self.backups.create(name, self.instance_folder + name, keep)
+        finally:
+            with self._state_changed:
+                waiters = self._event_waiters.get(name, [])
+                if ("saved", saved) in waiters:
+                    waiters.remove(("saved", saved))
+            watcher.write("save-on\n")
+
+    def restore_server(self, name: str, backup_id: str) -> None:
+        """Replaces a stopped server's files with a backup, keeping its logs"""
+        with self.server_lock(name):
+            self._restore_server(name, backup_id)
+
+    def _restore_server(self, name: str, backup_id: str) -> None:
         if name in self:
-            return
-        self._server_states[name] = "starting"
+            raise RuntimeError("server is running")
+        staging = self.instance_folder + ".restore-" + name
+        shutil.rmtree(staging, ignore_errors=True)
+        self.backups.restore(name, backup_id, staging)
+
+        current = self.instance_folder + name
+        if os.path.exists(current):
+            for excluded in self.backups.exclude:
+                if os.path.exists(current + "/" + excluded) and not os.path.exists(
+                    staging + "/" + excluded
+                ):
+                    os.rename(current + "/" + excluded, staging + "/" + excluded)
+            # a dot name keeps the restore out of the deleteprogress broadcasts
+            self.trash.move(current, ".restore-" + name)
+        os.rename(staging, current)
+        self._refresh_inventory(force=True)
+
+    def history(
+        self, name: str, create: bool = False
+    ) -> vconsole.ConsoleArchive | None:
+        """
+        Returns the console archive of a server. Archives written before are
+        opened on demand, so their scrollback is available after a restart.
+        """
+        folder = self.instance_folder + name + "/logs/console/"
+        with self._inventory_lock:
+            if name not in self.histories and (create or os.path.isdir(folder)):
+                self.histories[name] = vconsole.ConsoleArchive(folder)
+            return self.histories.get(name)
+
+    def server_lock(self, name: str) -> threading.Lock:
+        """
+        Returns the lock held while a server is started, deleted or restored,
+        so that checking whether it runs and acting on that is atomic
+        """
+        with self._inventory_lock:
+            return self._server_locks.setdefault(name, threading.Lock())
+
+    def start_server(self, name: str) -> bool:
+        """Starts a server, returns False if it was already running"""
+        with self.server_lock(name):
+            return self._start_server(name)
+
+    def _start_server(self, name: str) -> bool:
+        if name in self:
+            return False
+        settings = self.get_settings(name)
+        self._fix_run_script(name)
+        self._set_state(name, "starting")
+        history = self.history(name, create=True)
+        history.max_bytes = settings.get("console_history_bytes", 64 * 1024**2)
+        history.max_lines = settings.get("console_history_lines", 0)
+        self.parsers[name] = consoleparser.ConsoleParser(
+            settings.get("software", "vanilla")
+        )
+        end = history.append("\033[2J\033[H")
+        self.console_fanout.push(name, "\033[2J\033[H", end - 7, end)
+        preexec_fn = None
+        if any(settings.get(key) for key in ("memory_max", "cpu_max", "cpus")):
+            try:
+                cgroup = resources.prepare_cgroup(
+                    name,
+                    settings.get("memory_max"),
+                    settings.get("cpu_max"),
+                    self.cgroup_root,
+                )
+                preexec_fn = resources.preexec(cgroup, settings.get("cpus"))
+            except OSError as e:
+                print(f"Applying resource limits to {name} failed: {e}")
         self[name] = vconsole.ConsoleWatcher(
             [self.instance_folder + name + "/run.sh"],
             lambda output: self.handle_output(name, output),
             self.instance_folder + name,
+            history,
+            preexec_fn,
+        )
+        if not self[name].watching:
+            self.pop(name, None)
+        return True
+
+    def autostart(self, concurrency: int = 2, timeout: float = 300) -> list:
+        """Starts every server with autostart set, see start_servers"""
+        return self.start_servers(
+            [
+                name
+                for name, settings in self.list_servers().items()
+                if settings.get("autostart")
+            ],
+            concurrency,
+            timeout,
+        )
+
+    def start_servers(
+        self, names: list, concurrency: int = 2, timeout: float = 300, on_progress=None
+    ) -> list:
+        """
+        Starts servers, highest autostart_priority first. At most concurrency
+        servers are starting at the same time; a server frees its slot once
+        it is ready, has stopped or has been starting for timeout seconds.
+        on_progress(name, result) is called after every start. Returns the
+        names of the started servers.
+        """
+        servers = self.list_servers()
+        order = sorted(
+            (-servers[name].get("autostart_priority", 0), name)
+            for name in names
+            if name in servers
         )
-        self.handle_output(name, "\033[2J\033[H")
-        self[name].console_history += "\033[2J\033[H"
+        started = []
+        starting = {}
+        for _, name in order:
+            with self._state_changed:
+                while True:
+                    now = time.monotonic()
+                    for other, since in list(starting.items()):
+                        if (
+                            self._server_states.get(other) != "starting"
+                            or now - since >= timeout
+                        ):
+                            del starting[other]
+                    if len(starting) < concurrency:
+                        break
+                    self._state_changed.wait(min(starting.values()) + timeout - now)
+            try:
+                if not self.start_server(name):
+                    self._report(on_progress, name, "running")
+                    continue
+            except Exception:
+                print("Exception occured:\n" + traceback.format_exc())
+                self._report(on_progress, name, "failed")
+                continue
+            starting[name] = time.monotonic()
+            started.append(name)
+            self._report(on_progress, name, "started")
+        return started
+
+    def _report(self, on_progress, name: str, result: str) -> None:
+        """Calls on_progress, a failing callback must not abort a bulk operation"""
+        if on_progress is None:
+            return
+        try:
+            on_progress(name, result)
+        except Exception:
+            print("Exception occured:\n" + traceback.format_exc())
+
+    def _wait_stopped(self, name: str, timeout: float) -> bool:
+        with self._state_changed:
+            return self._state_changed.wait_for(lambda: name not in self, timeout)
+
+    def stop_server(
+        self, name: str, timeout: float = 60, kill_timeout: float = 10
+    ) -> str:
+        """
+        Sends stop to a server and waits up to timeout seconds for it to
+        exit, then sends SIGTERM and finally SIGKILL to its process group.
+        Returns "stopped", "terminated", "killed" or "not running".
+        """
+        watcher = self.get(name)
+        if watcher is None:
+            return "not running"
+        watcher.write("stop\n")
+        if self._wait_stopped(name, timeout):
+            return "stopped"
+        for result, sig in (("terminated", signal.SIGTERM), ("killed", signal.SIGKILL)):
+            try:
+                # the pty child is a session leader, its pgid is its pid
+                os.killpg(watcher.process.pid, sig)
+            except ProcessLookupError:
+                pass
+            if self._wait_stopped(name, kill_timeout):
+                return result
+        return "killed"
+
+    def stop_servers(
+        self,
+        names: list | None = None,
+        timeout: float = 60,
+        kill_timeout: float = 10,
+        on_progress=None,
+    ) -> dict:
+        """
+        Stops servers (all running ones by default) concurrently, see
+        stop_server. on_progress(name, result) is called as each one exits.
+        Returns {name: result}.
+        """
+        if names is None:
+            names = list(self)
+        results = {}
+        if not names:
+            return results
+        with concurrent.futures.ThreadPoolExecutor(len(names)) as pool:
+            futures = {
+                pool.submit(self.stop_server, name, timeout, kill_timeout): name
+                for name in names
+            }
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    print("Exception occured:\n" + traceback.format_exc())
+                    results[name] = "failed"
+                self._report(on_progress, name, results[name])
+        return results
+
+    def server_state(self, name: str) -> str:
+        if not self.server_exists(name):
+            raise KeyError(name)
+        return self._server_states.get(name, "stopped")
 
     def server_states(self) -> dict:
-        for server in self.list_servers().keys():
-            if server not in self:
-                self._server_states[server] = "stopped"
-        return self._server_states
+        return {
+            server: self._server_states.get(server, "stopped")
+            for server in self.list_servers()
+        }
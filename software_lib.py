@@ -1,27 +1,212 @@
 import requests
+import collections
+import concurrent.futures
+import hashlib
+import json
 import os
 import subprocess
 import re
+import threading
+import time
+
+CACHE_DIR = "/var/andromeda/cache/"
+
+session = requests.Session()
+session.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+)
+session.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+)
 
 
 def _compare_versions(version):
     return [int(x) for x in re.split(r"\.", version)]
 
 
+class CachedDocument:
+    """
+    JSON document mirrored to a snapshot file on disk
+
+    The last known copy is loaded from the snapshot instantly; refresh()
+    revalidates it with a conditional request (ETag / Last-Modified).
+    """
+
+    def __init__(self, url: str, cache_file: str) -> None:
+        self.url = url
+        self.cache_file = cache_file
+        self.data = None
+        self.etag = None
+        self.last_modified = None
+        self.fetched = 0.0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.cache_file, "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        if snapshot.get("url") != self.url:
+            return
+        self.data = snapshot["data"]
+        self.etag = snapshot.get("etag")
+        self.last_modified = snapshot.get("last_modified")
+        self.fetched = snapshot.get("fetched", 0.0)
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(self.cache_file + ".tmp", "w") as f:
+            json.dump(
+                {
+                    "url": self.url,
+                    "etag": self.etag,
+                    "last_modified": self.last_modified,
+                    "fetched": self.fetched,
+                    "data": self.data,
+                },
+                f,
+            )
+        os.replace(self.cache_file + ".tmp", self.cache_file)
+
+    def refresh(self, timeout: float = 10) -> bool:
+        """Revalidates the document, returns True if it changed"""
+        with self._lock:
+            headers = {}
+            if self.data is not None and self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.data is not None and self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+            response = session.get(self.url, headers=headers, timeout=timeout)
+            self.fetched = time.time()
+            if response.status_code == 304:
+                self._save()
+                return False
+            response.raise_for_status()
+            self.data = response.json()
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            self._save()
+            return True
+
+    def get(self):
+        if self.data is None:
+            self.refresh()
+        return self.data
+
+
+class MetadataCache:
+    """
+    TTL + LRU cache for per-version metadata documents
+
+    Concurrent get() calls for a key that is not cached share a single
+    in-flight fetch instead of each hitting the upstream API.
+    """
+
+    def __init__(self, ttl: float = 600, max_entries: int = 256) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = concurrent.futures.Future()
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+metadata_cache = MetadataCache()
+
+
+def get_json(url: str, timeout: float = 10):
+    def fetch():
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    return metadata_cache.get(url, fetch)
+
+
+def refresh_catalogs(catalogs: list, interval: float = 6 * 3600, on_error=None):
+    """Keeps the given catalogs fresh from a background thread"""
+
+    def loop():
+        while True:
+            for catalog in catalogs:
+                try:
+                    catalog.document.refresh()
+                except (requests.RequestException, ValueError) as e:
+                    if on_error:
+                        on_error(catalog.document.url, e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+
 class PaperData:
-    def __init__(self) -> None:
-        self.string = requests.get("https://papermc.io/api/v2/projects/paper").json()
+    def __init__(
+        self,
+        url: str = "https://papermc.io/api/v2/projects/paper",
+        cache_dir: str = CACHE_DIR,
+        download_api_url: str = "https://api.papermc.io/v2/projects/paper",
+    ) -> None:
+        self.document = CachedDocument(url, cache_dir + "paper.json")
+        self.download_api_url = download_api_url
+
+    @property
+    def string(self) -> dict:
+        return self.document.get()
 
     def mc_versions(self) -> list:
         return list(reversed(self.string["versions"]))
 
+    def build_data(self, mc_version: str) -> "PaperBuildData":
+        return PaperBuildData(mc_version, self.document.url, self.download_api_url)
+
 
 class PaperBuildData:
-    def __init__(self, mc_version: str) -> None:
+    def __init__(
+        self,
+        mc_version: str,
+        api_url: str = "https://papermc.io/api/v2/projects/paper",
+        download_api_url: str = "https://api.papermc.io/v2/projects/paper",
+    ) -> None:
         self.mc_version = mc_version
-        self.string = requests.get(
-            "https://papermc.io/api/v2/projects/paper/versions/" + mc_version
-        ).json()
+        self.api_url = api_url
+        self.download_api_url = download_api_url
+        self.string = get_json(api_url + "/versions/" + mc_version)
 
     def builds(self) -> list:
         return list(reversed(self.string["builds"]))
@@ -30,14 +215,24 @@ class PaperBuildData:
         return self.builds()[0]
 
     def download_url(self, build_id: int | str) -> str:
-        return f"https://api.papermc.io/v2/projects/paper/versions/{self.mc_version}/builds/{build_id}/downloads/paper-{self.mc_version}-{build_id}.jar"
+        return f"{self.download_api_url}/versions/{self.mc_version}/builds/{build_id}/downloads/paper-{self.mc_version}-{build_id}.jar"
+
+    def checksum(self, build_id: int | str) -> tuple:
+        build = get_json(f"{self.api_url}/versions/{self.mc_version}/builds/{build_id}")
+        return "sha256", build["downloads"]["application"]["sha256"]
 
 
 class VanillaData:
-    def __init__(self) -> None:
-        self.string = requests.get(
-            "https://launchermeta.mojang.com/mc/game/version_manifest.json"
-        ).json()
+    def __init__(
+        self,
+        url: str = "https://launchermeta.mojang.com/mc/game/version_manifest.json",
+        cache_dir: str = CACHE_DIR,
+    ) -> None:
+        self.document = CachedDocument(url, cache_dir + "vanilla.json")
+
+    @property
+    def string(self) -> dict:
+        return self.document.get()
 
     def mc_versions(self) -> list:
         return [
@@ -46,21 +241,34 @@ class VanillaData:
             if version["type"] == "release" and int(version["id"].split(".")[1]) >= 3
         ]
 
-    def download_url(self, mc_version: str) -> str:
+    def _package(self, mc_version: str) -> dict:
         packageurl = ""
         for element in self.string["versions"]:
             if element["id"] == mc_version:
                 packageurl = element["url"]
                 break
-        packagestr = requests.get(packageurl).json()
-        return packagestr["downloads"]["server"]["url"]
+        return get_json(packageurl)
+
+    def download_url(self, mc_version: str) -> str:
+        return self._package(mc_version)["downloads"]["server"]["url"]
+
+    def checksum(self, mc_version: str) -> tuple:
+        return "sha1", self._package(mc_version)["downloads"]["server"]["sha1"]
 
 
 class ForgeData:
-    def __init__(self) -> None:
-        self.string = requests.get(
-            "https://meta.multimc.org/v1/net.minecraftforge"
-        ).json()
+    def __init__(
+        self,
+        url: str = "https://meta.multimc.org/v1/net.minecraftforge",
+        cache_dir: str = CACHE_DIR,
+        maven_url: str = "https://maven.minecraftforge.net/net/minecraftforge/forge",
+    ) -> None:
+        self.document = CachedDocument(url, cache_dir + "forge.json")
+        self.maven_url = maven_url
+
+    @property
+    def string(self) -> dict:
+        return self.document.get()
 
     def mc_versions(self) -> list:
         return sorted(
@@ -86,12 +294,20 @@ class ForgeData:
         return self.forge_versions(mc_version)[0]
 
     def download_url(self, mc_version: str, build: str) -> str:
-        return f"https://maven.minecraftforge.net/net/minecraftforge/forge/{mc_version}-{build}/forge-{mc_version}-{build}-installer.jar"
+        return f"{self.maven_url}/{mc_version}-{build}/forge-{mc_version}-{build}-installer.jar"
 
 
 class FabricData:
-    def __init__(self) -> None:
-        self.string = requests.get("https://meta.fabricmc.net/v2/versions/").json()
+    def __init__(
+        self,
+        url: str = "https://meta.fabricmc.net/v2/versions/",
+        cache_dir: str = CACHE_DIR,
+    ) -> None:
+        self.document = CachedDocument(url, cache_dir + "fabric.json")
+
+    @property
+    def string(self) -> dict:
+        return self.document.get()
 
     def mc_versions(self) -> list:
         return [
@@ -106,16 +322,113 @@ class FabricData:
 
     def download_url(self, mc_version: str, fabric_version: str) -> str:
         installer = self.string["installer"][0]["version"]
-        return f"https://meta.fabricmc.net/v2/versions/loader/{mc_version}/{fabric_version}/{installer}/server/jar"
+        return f"{self.document.url}loader/{mc_version}/{fabric_version}/{installer}/server/jar"
+
+
+class ChecksumError(Exception):
+    pass
+
 
+def _download_part(url, part, on_progress, chunk_size, timeout) -> None:
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            return
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        total = int(response.headers.get("Content-Length", 0)) + offset or None
+        received = offset
+        last_report = 0.0
+        with open(part, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                received += len(chunk)
+                if on_progress and time.monotonic() - last_report >= 0.5:
+                    last_report = time.monotonic()
+                    on_progress(received, total)
+        if on_progress:
+            on_progress(received, total)
 
-def get_java_versions() -> dict:
+
+def download(
+    url: str,
+    dest: str,
+    checksum: tuple | None = None,
+    on_progress=None,
+    retries: int = 3,
+    chunk_size: int = 256 * 1024,
+    timeout: float = 30,
+) -> None:
+    """
+    Streams url to dest
+
+    Data is written to dest + ".part"; a retry resumes it with a Range request.
+    checksum is an (algorithm, hexdigest) tuple the file is verified against
+    before it is atomically moved to dest.
+    """
+    part = dest + ".part"
+    for attempt in range(retries + 1):
+        try:
+            _download_part(url, part, on_progress, chunk_size, timeout)
+            break
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            time.sleep(2**attempt)
+
+    if checksum:
+        algorithm, expected = checksum
+        digest = hashlib.new(algorithm)
+        with open(part, "rb") as f:
+            while block := f.read(1024 * 1024):
+                digest.update(block)
+        if digest.hexdigest() != expected.lower():
+            os.remove(part)
+            raise ChecksumError(f"{algorithm} mismatch for {url}")
+    os.replace(part, dest)
+
+
+_java_cache = {}
+_java_cache_lock = threading.Lock()
+
+
+def _probe_java(java_instance: str, java_path: str, read_release: bool) -> str | None:
+    if read_release:
+        try:
+            with open(java_instance + "/release", "r") as f:
+                for line in f:
+                    if line.startswith("JAVA_VERSION="):
+                        version = line.split("=", 1)[1].strip().strip('"')
+                        if re.fullmatch(r"[\.\d_]+", version):
+                            return version
+                        break
+        except OSError:
+            pass
+    return_val = subprocess.run((java_path, "-version"), capture_output=True)
+    lines = return_val.stderr.splitlines()
+    if not lines:
+        return None
+    match = re.search(r"\"([\.\d_]*)\"", lines[0].decode())
+    if not match:
+        return None
+    return match.group(1)
+
+
+def get_java_versions(jvm_dir: str = "/usr/lib/jvm", read_release: bool = True) -> dict:
+    """
+    Finds the installed java runtimes
+
+    Probe results are cached per runtime and only redone when the java binary
+    changed (mtime / inode). New runtimes are probed in parallel.
+    """
     jvmdir = tuple(
-        "/usr/lib/jvm/" + jv
-        for jv in os.listdir("/usr/lib/jvm")
-        if not os.path.islink("/usr/lib/jvm/" + jv)
+        jvm_dir + "/" + jv
+        for jv in os.listdir(jvm_dir)
+        if not os.path.islink(jvm_dir + "/" + jv)
     )
-    versions = {}
+    java_paths = {}
     for java_instance in jvmdir:
         if "jdk" in os.listdir(java_instance):
             java_path = java_instance + "/jdk/bin/java"
@@ -123,13 +436,38 @@ def get_java_versions() -> dict:
             java_path = java_instance + "/jre/bin/java"
         else:
             java_path = java_instance + "/bin/java"
-        return_val = subprocess.run((java_path, "-version"), capture_output=True)
-        return_val = return_val.stderr.splitlines()[0]
-        match = re.search(r"\"([\.\d_]*)\"", return_val.decode())
-        if not match:
+        try:
+            stat = os.stat(java_path)
+        except OSError:
             continue
-        version = match.group(1).removeprefix("1.").split(".")[0]
-        versions[version] = java_path, match.group(1)
+        java_paths[java_instance] = java_path, (stat.st_mtime_ns, stat.st_ino)
+
+    with _java_cache_lock:
+        outdated = [
+            java_instance
+            for java_instance, (java_path, key) in java_paths.items()
+            if _java_cache.get(java_instance, (None, None, None))[:2]
+            != (java_path, key)
+        ]
+        if outdated:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(8, len(outdated))
+            ) as pool:
+                probed = pool.map(
+                    lambda java_instance: _probe_java(
+                        java_instance, java_paths[java_instance][0], read_release
+                    ),
+                    outdated,
+                )
+                for java_instance, version in zip(outdated, probed):
+                    _java_cache[java_instance] = (*java_paths[java_instance], version)
+
+        versions = {}
+        for java_instance, (java_path, _) in java_paths.items():
+            version = _java_cache[java_instance][2]
+            if not version:
+                continue
+            versions[version.removeprefix("1.").split(".")[0]] = java_path, version
     return versions
 
 
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consoleparser import ConsoleParser
+
+
+def test_marker_split_across_chunks():
+    parser = ConsoleParser("vanilla")
+    assert parser.feed("[12:00:01] [Server thread/INFO]: Done (3.2") == []
+    assert parser.feed('s)! For help, type "help"\r\n') == [
+        {"event": "ready", "seconds": "3.2"}
+    ]
+
+
+def test_paper_prompt_redraw():
+    parser = ConsoleParser("paper")
+    output = (
+        '> \r\x1b[K[12:00:01 INFO]: Done (3.2s)! For help, type "help"\r\n'
+        "> \x1b[?1h\x1b=\r\x1b[K\x1b[33m[12:00:05 INFO]: Steve joined the game\x1b[0m\r\n"
+        "> \r\x1b[K\x1b]0;Paper\x07[12:00:09 INFO]: Stopping the server\r\n"
+        "> "
+    )
+    assert parser.feed(output) == [
+        {"event": "ready", "seconds": "3.2"},
+        {"event": "join", "player": "Steve"},
+        {"event": "stopping"},
+    ]
+
+
+def test_ready_reported_once():
+    parser = ConsoleParser("paper")
+    events = parser.feed(
+        "[12:00:00 INFO]: Time elapsed: 3373 ms\n"
+        '[12:00:01 INFO]: Done (3.2s)! For help, type "help"\n'
+    )
+    assert events == [{"event": "ready", "ms": "3373"}]
+
+
+def test_chat_cannot_fake_events():
+    parser = ConsoleParser("vanilla")
+    assert parser.feed("[12:00:01] [Server thread/INFO]: <Eve> Stopping server\n") == []
@@ -0,0 +1,85 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from queuemgr import QueueManager
+
+
+def wait_idle(queue, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(queue):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_same_key_runs_in_order():
+    queue = QueueManager(lambda: None, workers=4)
+    order = []
+    for i in range(20):
+        queue.append((f"task {i}", lambda i=i: order.append(i), "server"))
+    wait_idle(queue)
+    queue.stop()
+    assert order == list(range(20))
+
+
+def test_same_key_never_overlaps():
+    queue = QueueManager(lambda: None, workers=4)
+    running = []
+    overlaps = []
+
+    def task():
+        running.append(1)
+        if len(running) > 1:
+            overlaps.append(1)
+        time.sleep(0.01)
+        running.pop()
+
+    for i in range(10):
+        queue.append((f"task {i}", task, "server"))
+    wait_idle(queue)
+    queue.stop()
+    assert overlaps == []
+
+
+def test_different_keys_run_concurrently():
+    queue = QueueManager(lambda: None, workers=2)
+    barrier = threading.Barrier(2, timeout=5)
+    queue.append(("a", barrier.wait, "a"))
+    queue.append(("b", barrier.wait, "b"))
+    wait_idle(queue)
+    queue.stop()
+    assert not barrier.broken
+
+
+def test_cancel_queued_task():
+    queue = QueueManager(lambda: None, workers=1)
+    release = threading.Event()
+    ran = []
+    queue.append(("blocker", release.wait, "server"))
+    task_id = queue.append(("cancelled", lambda: ran.append(1), "server"))
+    assert queue.cancel(task_id)
+    assert not queue.cancel(task_id)
+    release.set()
+    wait_idle(queue)
+    queue.stop()
+    assert ran == []
+
+
+def test_cancel_running_task_fails():
+    queue = QueueManager(lambda: None, workers=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def task():
+        started.set()
+        release.wait()
+
+    task_id = queue.append(("running", task))
+    assert started.wait(5)
+    assert not queue.cancel(task_id)
+    release.set()
+    wait_idle(queue)
+    queue.stop()
@@ -0,0 +1,108 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vconsole
+from vconsole import ConsoleArchive, ConsoleHistory
+
+
+def test_offsets_grow_across_appends():
+    history = ConsoleHistory()
+    assert history.append("abc") == 3
+    assert history.append("de\n") == 6
+    assert history.read(0) == (0, 6, "abcde\n")
+    assert history.read(2, 4) == (2, 4, "cd")
+
+
+def test_resync_from_since():
+    history = ConsoleHistory()
+    history.append("first\n")
+    since = history.end
+    history.append("second\n")
+    assert history.read(since) == (since, history.end, "second\n")
+    assert history.read(history.end) == (history.end, history.end, "")
+
+
+def test_read_after_eviction_is_truncated():
+    history = ConsoleHistory(max_bytes=10, max_lines=0)
+    for i in range(5):
+        history.append(f"line {i}\n")
+    assert history.start > 0
+    start, end, text = history.read(0)
+    # a reader resuming from 0 learns it missed output through start > since
+    assert start == history.start
+    assert end == history.end
+    assert text.endswith("line 4\n")
+
+
+def test_line_limit():
+    history = ConsoleHistory(max_bytes=0, max_lines=2)
+    for i in range(5):
+        history.append(f"{i}\n")
+    assert history.tail() == "3\n4\n"
+
+
+def test_end_offset_inside_utf8_character():
+    history = ConsoleHistory()
+    history.append("aé b")
+    # start falls into the middle of é, the partial character is dropped
+    assert history.read(2) == (2, 5, " b")
+
+
+def test_archive_evicts_whole_segments_by_bytes(tmp_path):
+    archive = ConsoleArchive(f"{tmp_path}/", max_bytes=300, segment_size=100)
+    for i in range(100):
+        archive.append(f"line {i:04d}\n")
+    assert archive.end == 1000
+    assert 300 <= len(archive) < 400
+    assert archive.start % 100 == 0
+    assert archive.tail().endswith("line 0099\n")
+    assert len(os.listdir(tmp_path)) == 2 * len(archive._segments)
+    archive.close()
+
+
+def test_archive_evicts_by_lines(tmp_path):
+    archive = ConsoleArchive(f"{tmp_path}/", max_bytes=0, max_lines=40)
+    for i in range(1000):
+        archive.append(f"{i}\n")
+    lines = archive.tail().splitlines()
+    assert 40 <= len(lines) <= 60
+    assert lines[-1] == "999"
+    archive.close()
+
+
+def test_archive_reopen_continues_offsets(tmp_path):
+    archive = ConsoleArchive(f"{tmp_path}/", segment_size=10)
+    archive.append("first line\n")
+    archive.append("second line\n")
+    end = archive.end
+    archive.close()
+
+    reopened = ConsoleArchive(f"{tmp_path}/", segment_size=10)
+    assert (reopened.start, reopened.end) == (0, end)
+    # without a line limit the segments are not read just to count lines
+    assert reopened._line_counts is None
+    assert reopened.read(0) == (0, end, "first line\nsecond line\n")
+    assert reopened.append("third\n") == end + 6
+    assert reopened.read(end) == (end, end + 6, "third\n")
+    reopened.close()
+
+
+def test_archive_offset_at(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(vconsole.time, "time", lambda: now[0])
+    archive = ConsoleArchive(f"{tmp_path}/", index_interval=1.0)
+    offsets = {}
+    for second in range(10):
+        now[0] = 1000.0 + second
+        offsets[now[0]] = archive.end
+        archive.append(f"second {second}\n")
+
+    assert archive.offset_at(0) == 0
+    assert archive.offset_at(1004.0) == offsets[1004.0]
+    assert archive.offset_at(1004.5) == offsets[1004.0]
+    assert archive.offset_at(2000.0) == offsets[1009.0]
+    start, end, text = archive.read(archive.offset_at(1007.0))
+    assert text.startswith("second 7\n")
+    archive.close()
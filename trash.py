@@ -0,0 +1,102 @@
+import collections
+import os
+import threading
+import time
+import traceback
+
+
+class Trash:
+    """
+    Staging area for deleted instances
+
+    move renames a directory into the trash folder, which is atomic and
+    instant as long as both are on the same filesystem. A single background
+    thread running at the lowest CPU priority then removes the staged trees,
+    at most files_per_second entries per second (0 for no limit), and reports
+    progress through on_progress(name, progress) at most every
+    progress_interval seconds. Leftovers from a previous run are reclaimed
+    on start.
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        on_progress=None,
+        files_per_second: int = 2000,
+        progress_interval: float = 0.5,
+    ) -> None:
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.on_progress = on_progress
+        self.files_per_second = files_per_second
+        self.progress_interval = progress_interval
+        self.progress = {}
+        self._pending = collections.deque(sorted(os.listdir(folder)))
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def move(self, path: str, name: str) -> None:
+        entry = f"{name}.{time.time_ns()}"
+        os.rename(path, self.folder + entry)
+        with self._cond:
+            self._pending.append(entry)
+            self._cond.notify()
+
+    def _loop(self) -> None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except OSError:
+            pass
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                entry = self._pending.popleft()
+            try:
+                self._reclaim(entry)
+            except Exception:
+                print("Exception occured:\n" + traceback.format_exc())
+
+    def _reclaim(self, entry: str) -> None:
+        name = entry.rsplit(".", 1)[0]
+        path = self.folder + entry
+        progress = {"files": 0, "total_files": 0, "bytes": 0, "total_bytes": 0}
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                progress["total_files"] += 1
+                progress["total_bytes"] += os.lstat(os.path.join(root, file)).st_size
+        self.progress[name] = progress
+
+        started = reported = time.monotonic()
+        removed = 0
+        for root, dirs, files in os.walk(path, topdown=False):
+            for file in files:
+                file = os.path.join(root, file)
+                size = os.lstat(file).st_size
+                os.unlink(file)
+                progress["files"] += 1
+                progress["bytes"] += size
+                removed += 1
+                if removed % 64:
+                    continue
+
+                now = time.monotonic()
+                if self.files_per_second:
+                    ahead = started + removed / self.files_per_second - now
+                    if ahead > 0:
+                        time.sleep(ahead)
+                if self.on_progress and now - reported >= self.progress_interval:
+                    reported = now
+                    self.on_progress(name, dict(progress))
+            for directory in dirs:
+                directory = os.path.join(root, directory)
+                if os.path.islink(directory):
+                    os.unlink(directory)
+                else:
+                    os.rmdir(directory)
+        os.rmdir(path)
+
+        del self.progress[name]
+        if self.on_progress:
+            self.on_progress(name, {**progress, "done": True})
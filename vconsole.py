@@ -1,35 +1,435 @@
+import codecs
+import collections
+import errno
+import mmap
+import os
 import ptyprocess
+import selectors
+import struct
 import threading
+import time
+import traceback
+
+
+class ConsoleHistory:
+    """
+    Bounded console scrollback
+
+    Keeps the most recent output chunks and evicts the oldest ones as soon as
+    more than max_bytes or max_lines are retained. A limit of 0 disables it.
+
+    Output is addressed by byte offsets that grow monotonically over the
+    lifetime of the history: start is the offset of the oldest retained byte,
+    end the offset right after the newest one.
+    """
+
+    def __init__(self, max_bytes: int = 1024 * 1024, max_lines: int = 10000) -> None:
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.start = 0
+        self.end = 0
+        self._chunks = collections.deque()
+        self._lines = 0
+        self._lock = threading.Lock()
+
+    def _over_limit(self) -> bool:
+        return (self.max_bytes and len(self) > self.max_bytes) or (
+            self.max_lines and self._lines > self.max_lines
+        )
+
+    def append(self, text: str) -> int:
+        """Appends text, returns the new end offset"""
+        chunk = text.encode()
+        with self._lock:
+            self._chunks.append((self.end, chunk))
+            self.end += len(chunk)
+            self._lines += chunk.count(b"\n")
+            while len(self._chunks) > 1 and self._over_limit():
+                _, evicted = self._chunks.popleft()
+                self.start += len(evicted)
+                self._lines -= evicted.count(b"\n")
+            return self.end
+
+    def read(self, start: int, end: int | None = None) -> tuple:
+        """
+        Returns (start, end, text) for the retained output between start and
+        end. start is moved forward if that part was already evicted.
+        """
+        with self._lock:
+            start = max(start, self.start)
+            end = self.end if end is None else min(end, self.end)
+            parts = []
+            for offset, chunk in self._chunks:
+                if offset + len(chunk) <= start or offset >= end:
+                    continue
+                parts.append(chunk[max(start - offset, 0) : end - offset])
+            return start, end, b"".join(parts).decode(errors="ignore")
+
+    def page(self, before: int, limit: int = 64 * 1024) -> tuple:
+        """Returns (start, end, text) for up to limit bytes preceding before"""
+        return self.read(max(before - limit, 0), before)
+
+    def tail(self) -> str:
+        return self.read(0)[2]
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __str__(self) -> str:
+        return self.tail()
+
+
+class ConsoleArchive:
+    """
+    Console scrollback kept on disk
+
+    Offers the ConsoleHistory interface, but appends output to segment files
+    in folder (<start offset>.log, rolled over every segment_size bytes) and
+    reads it back through mmap, so scrollback survives restarts of the server
+    and of stall without living on the heap. Whole segments are deleted,
+    oldest first, once more than max_bytes or max_lines are retained. A limit
+    of 0 disables it; with max_lines set a segment is also rolled over after
+    a quarter of max_lines lines.
+
+    Every segment has an index (<start offset>.idx) of (time, offset) records,
+    written at most every index_interval seconds or index_bytes bytes, that
+    offset_at uses to find the output from a given time on.
+    """
+
+    _RECORD = struct.Struct("<dQ")
+
+    def __init__(
+        self,
+        folder: str,
+        max_bytes: int = 64 * 1024**2,
+        max_lines: int = 0,
+        segment_size: int = 4 * 1024**2,
+        index_interval: float = 1.0,
+        index_bytes: int = 64 * 1024,
+    ) -> None:
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.index_bytes = index_bytes
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._fd = None
+        self._index_fd = None
+        self._last_index = (0.0, 0)
+
+        self._segments = sorted(
+            int(file[:-4]) for file in os.listdir(folder) if file.endswith(".log")
+        )
+        # lines per segment, only counted while max_lines is set
+        self._line_counts = None
+        self._lines = 0
+        if self._segments:
+            self.start = self._segments[0]
+            self.end = self._segments[-1] + os.path.getsize(
+                self._path(self._segments[-1])
+            )
+        else:
+            self.start = self.end = 0
+
+    def _path(self, segment: int, suffix: str = ".log") -> str:
+        return f"{self.folder}{segment:020d}{suffix}"
+
+    def _roll(self) -> None:
+        self._close_files()
+        self._segments.append(self.end)
+        if self._line_counts is not None:
+            self._line_counts[self.end] = 0
+        self._fd = os.open(
+            self._path(self.end), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        self._index_fd = os.open(
+            self._path(self.end, ".idx"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        self._last_index = (0.0, self.end)
+
+    def _close_files(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            os.close(self._index_fd)
+            self._fd = self._index_fd = None
+
+    def _count_lines(self) -> None:
+        if self._line_counts is not None:
+            return
+        self._line_counts = {}
+        for segment in self._segments:
+            with open(self._path(segment), "rb") as f:
+                self._line_counts[segment] = f.read().count(b"\n")
+        self._lines = sum(self._line_counts.values())
+
+    def _over_limit(self) -> bool:
+        """Whether the retained output still exceeds a limit without the oldest segment"""
+        return (self.max_bytes and self.end - self._segments[1] >= self.max_bytes) or (
+            self.max_lines
+            and self._lines - self._line_counts[self._segments[0]] >= self.max_lines
+        )
+
+    def _evict(self) -> None:
+        while len(self._segments) > 1 and self._over_limit():
+            segment = self._segments.pop(0)
+            if self._line_counts is not None:
+                self._lines -= self._line_counts.pop(segment)
+            if segment in self._maps:
+                self._maps.pop(segment).close()
+            for suffix in (".log", ".idx"):
+                try:
+                    os.remove(self._path(segment, suffix))
+                except FileNotFoundError:
+                    pass
+            self.start = self._segments[0]
+
+    def append(self, text: str) -> int:
+        """Appends text, returns the new end offset"""
+        chunk = text.encode()
+        with self._lock:
+            if self.max_lines:
+                self._count_lines()
+            else:
+                self._line_counts = None
+            if (
+                self._fd is None
+                or self.end - self._segments[-1] >= self.segment_size
+                or self.max_lines
+                and self._line_counts[self._segments[-1]] >= self.max_lines // 4 + 1
+            ):
+                self._roll()
+            now = time.time()
+            last_time, last_offset = self._last_index
+            if (
+                now - last_time >= self.index_interval
+                or self.end - last_offset >= self.index_bytes
+            ):
+                os.write(self._index_fd, self._RECORD.pack(now, self.end))
+                self._last_index = (now, self.end)
+            os.write(self._fd, chunk)
+            self.end += len(chunk)
+            if self._line_counts is not None:
+                lines = chunk.count(b"\n")
+                self._line_counts[self._segments[-1]] += lines
+                self._lines += lines
+            self._evict()
+            return self.end
+
+    def _map(self, segment: int):
+        """Returns an mmap of a segment, cached once the segment is complete"""
+        if segment in self._maps:
+            return self._maps[segment]
+        with open(self._path(segment), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if segment != self._segments[-1]:
+            self._maps[segment] = data
+        return data
+
+    def read(self, start: int, end: int | None = None) -> tuple:
+        """
+        Returns (start, end, text) for the retained output between start and
+        end. start is moved forward if that part was already evicted.
+        """
+        with self._lock:
+            start = max(start, self.start)
+            end = self.end if end is None else min(end, self.end)
+            parts = []
+            for i, segment in enumerate(self._segments):
+                segment_end = (
+                    self._segments[i + 1] if i + 1 < len(self._segments) else self.end
+                )
+                if segment_end <= start or segment >= end:
+                    continue
+                data = self._map(segment)
+                parts.append(data[max(start - segment, 0) : end - segment])
+                if data and segment not in self._maps:
+                    data.close()
+            return start, end, b"".join(parts).decode(errors="ignore")
+
+    def page(self, before: int, limit: int = 64 * 1024) -> tuple:
+        """Returns (start, end, text) for up to limit bytes preceding before"""
+        return self.read(max(before - limit, 0), before)
+
+    def offset_at(self, timestamp: float) -> int:
+        """Returns an offset at or shortly before the output written at timestamp"""
+        with self._lock:
+            offset = self.start
+            for segment in self._segments:
+                try:
+                    with open(self._path(segment, ".idx"), "rb") as f:
+                        records = f.read()
+                except FileNotFoundError:
+                    continue
+                size = self._RECORD.size
+                for i in range(0, len(records) - size + 1, size):
+                    recorded, recorded_offset = self._RECORD.unpack_from(records, i)
+                    if recorded > timestamp:
+                        return offset
+                    offset = recorded_offset
+            return offset
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_files()
+            for data in self._maps.values():
+                data.close()
+            self._maps.clear()
+
+    def tail(self) -> str:
+        return self.read(0)[2]
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __str__(self) -> str:
+        return self.tail()
+
+
+class ConsoleReactor:
+    """
+    Reads the PTYs of all console watchers from a single thread
+
+    Read sizes adapt per console: a read that fills its buffer doubles the
+    next one (up to max_read), a short read halves it (down to min_read), so
+    bursty consoles are drained in a few large reads and quiet ones stay cheap.
+    Output callbacks run on the reactor thread and must not block.
+    """
+
+    def __init__(self, min_read: int = 4096, max_read: int = 256 * 1024) -> None:
+        self.min_read = min_read
+        self.max_read = max_read
+        self._selector = selectors.DefaultSelector()
+        self._pending = collections.deque()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def register(self, watcher: "ConsoleWatcher") -> None:
+        watcher.read_size = self.min_read
+        self._pending.append(watcher)
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    def __len__(self) -> int:
+        return len(self._selector.get_map()) - 1
+
+    def _loop(self) -> None:
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._register_pending()
+                else:
+                    self._read(key.data)
+
+    def _register_pending(self) -> None:
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._pending:
+            watcher = self._pending.popleft()
+            self._selector.register(watcher.process.fd, selectors.EVENT_READ, watcher)
+
+    def _read(self, watcher: "ConsoleWatcher") -> None:
+        try:
+            data = os.read(watcher.process.fd, watcher.read_size)
+        except OSError as e:
+            # the pty master reports EIO once the child side is closed
+            if e.errno != errno.EIO:
+                self._dispatch(
+                    watcher,
+                    f"*** exception occured while reading output: {e} ***",
+                )
+            data = b""
+
+        if not data:
+            self._selector.unregister(watcher.process.fd)
+            watcher.watching = False
+            watcher._close()
+            self._dispatch(watcher, "*** process stopped ***")
+            return
+
+        if len(data) == watcher.read_size:
+            watcher.read_size = min(watcher.read_size * 2, self.max_read)
+        else:
+            watcher.read_size = max(watcher.read_size // 2, self.min_read)
+        output = watcher.decoder.decode(data)
+        if output:
+            self._dispatch(watcher, output)
+
+    def _dispatch(self, watcher: "ConsoleWatcher", output: str) -> None:
+        try:
+            watcher._output(output)
+        except Exception:
+            print("Exception occured:\n" + traceback.format_exc())
+
+
+_reactor = None
+_reactor_lock = threading.Lock()
+
+
+def reactor() -> ConsoleReactor:
+    """Returns the process-wide console reactor, starting it on first use"""
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None:
+            _reactor = ConsoleReactor()
+        return _reactor
 
 
 class ConsoleWatcher:
-    def __init__(self, args: list, on_output_change, start_dir: str):
+    def __init__(
+        self,
+        args: list,
+        on_output_change,
+        start_dir: str,
+        console_history: ConsoleHistory | None = None,
+        preexec_fn=None,
+    ):
         self.args = args
         self.on_output_change = on_output_change
-        self.process = ptyprocess.PtyProcessUnicode.spawn(self.args, cwd=start_dir)
+        self.process = ptyprocess.PtyProcessUnicode.spawn(
+            self.args, cwd=start_dir, preexec_fn=preexec_fn
+        )
         self.watching = True
-        self.console_history = ""
+        if console_history is None:
+            console_history = ConsoleHistory()
+        self.console_history = console_history
 
-        self._watch_thread = threading.Thread(target=self._watch_output, daemon=True)
-        self._watch_thread.start()
+        self.read_size = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        reactor().register(self)
 
-    def _watch_output(self):
+    def _close(self) -> None:
+        """
+        Closes the PTY and reaps the child. PtyProcess.close (also run by its
+        __del__) sleeps before reaping, which must not happen on the reactor.
+        """
+        self.process.fileobj.close()
+        self.process.closed = True
         try:
-            while self.watching:
-                try:
-                    output = self.process.read(1024)
-                    if output:
-                        self.console_history += output
-                        self.on_output_change(output)
-                except EOFError:
-                    self.watching = False
-                    self.on_output_change("*** process stopped ***")
-                    break
-        except ptyprocess.PtyProcessError as e:
-            self.on_output_change(
-                f"*** exception occured while reading output: {e} ***"
-            )
+            alive = self.process.isalive()
+        except ptyprocess.PtyProcessError:
+            return
+        if alive:
+            # the child closed its side of the PTY but has not exited yet
+            threading.Thread(target=self.process.wait, daemon=True).start()
+
+    def _output(self, output: str) -> None:
+        self.console_history.append(output)
+        self.on_output_change(output)
 
     def write(self, text: str):
-        if self.process.isalive():
+        if self.watching and self.process.isalive():
             self.process.write(text)
@@ -0,0 +1,52 @@
+import json
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = ("json", "msgpack") if msgpack else ("json",)
+
+
+def encode(message, encoding: str = "json"):
+    if encoding == "msgpack":
+        return msgpack.packb(message)
+    return json.dumps(message)
+
+
+def decode(data):
+    """Decodes a received frame: text frames are JSON, binary ones msgpack"""
+    if isinstance(data, str):
+        return json.loads(data)
+    if msgpack is None:
+        raise ValueError("binary frames need msgpack")
+    return msgpack.unpackb(data)
+
+
+class Frame:
+    """
+    Outgoing message that is encoded at most once per wire encoding,
+    no matter to how many clients it is sent.
+
+    message may be a dict or an already JSON-encoded string.
+    """
+
+    def __init__(self, message) -> None:
+        self.message = message
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def encode(self, encoding: str = "json"):
+        with self._lock:
+            if encoding not in self._encoded:
+                if isinstance(self.message, str):
+                    if encoding == "json":
+                        self._encoded[encoding] = self.message
+                    else:
+                        self._encoded[encoding] = encode(
+                            json.loads(self.message), encoding
+                        )
+                else:
+                    self._encoded[encoding] = encode(self.message, encoding)
+            return self._encoded[encoding]
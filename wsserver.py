@@ -0,0 +1,174 @@
+import asyncio
+import collections
+import concurrent.futures
+import traceback
+import websockets
+import wire
+
+
+class WebSocket:
+    """
+    Client connection of the asyncio websocket transport
+
+    Offers the SimpleWebSocketServer handler interface (address, data,
+    sendMessage, handleConnected, handleMessage, handleClose). Handlers run on
+    a single dispatcher thread, so they may block without stalling the sockets.
+
+    sendMessage can be called from any thread. Messages go to a per-client
+    outbound queue that is drained by the event loop. Droppable messages
+    (console output) are discarded once max_droppable of them are waiting and
+    the client gets a "lagged" notice after it caught up. A client whose queue
+    exceeds max_queue is disconnected. Messages to closed clients, including
+    all of them once the server has shut down, are discarded.
+
+    Messages may be JSON strings, dicts or wire.Frame objects; they are
+    encoded in the client's wire encoding, which is JSON unless it was changed
+    (e.g. to msgpack) at auth time.
+    """
+
+    def __init__(self, server, websocket) -> None:
+        self.server = server
+        self.websocket = websocket
+        self.address = websocket.remote_address
+        self.data = None
+        self.encoding = "json"
+        self.closed = False
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._droppable = 0
+        self._dropped = 0
+        self._wakeup = asyncio.Event()
+
+    def handleConnected(self) -> None:
+        pass
+
+    def handleMessage(self) -> None:
+        pass
+
+    def handleClose(self) -> None:
+        pass
+
+    def sendMessage(self, data, droppable: bool = False) -> None:
+        if self.closed:
+            return
+        if not isinstance(data, wire.Frame):
+            data = wire.Frame(data)
+        try:
+            self.server.loop.call_soon_threadsafe(
+                self._enqueue, data.encode(self.encoding), droppable
+            )
+        except RuntimeError:
+            # the event loop is closed, so is the connection
+            self.closed = True
+
+    def _enqueue(self, data, droppable: bool) -> None:
+        if self.closed:
+            return
+        if droppable:
+            if self._droppable >= self.server.max_droppable:
+                self._dropped += 1
+                self.dropped += 1
+                return
+            self._droppable += 1
+        elif len(self._queue) >= self.server.max_queue:
+            self.closed = True
+            asyncio.ensure_future(self.websocket.close(1008, "client too slow"))
+            return
+        self._queue.append((data, droppable))
+        self._wakeup.set()
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._queue:
+                    data, droppable = self._queue.popleft()
+                    if droppable:
+                        self._droppable -= 1
+                    await self.websocket.send(data)
+                    self.messages_sent += 1
+                    self.bytes_sent += len(data)
+                if self._dropped:
+                    dropped, self._dropped = self._dropped, 0
+                    await self.websocket.send(
+                        wire.encode(
+                            {"data": "lagged", "dropped": dropped}, self.encoding
+                        )
+                    )
+        except websockets.ConnectionClosed:
+            pass
+
+    def _handle_message(self, message) -> None:
+        self.data = message
+        self.handleMessage()
+
+
+class WebSocketServer:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        websocketclass,
+        ssl_context=None,
+        max_queue: int = 1024,
+        max_droppable: int = 256,
+        compression: str | None = "deflate",
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.websocketclass = websocketclass
+        self.ssl_context = ssl_context
+        self.max_queue = max_queue
+        self.max_droppable = max_droppable
+        self.compression = compression
+        self.clients = set()
+        self.loop = None
+        self._stop = None
+        self._dispatcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _call(self, function, *args) -> None:
+        try:
+            function(*args)
+        except Exception:
+            print("Exception occured:\n" + traceback.format_exc())
+
+    async def _dispatch(self, function, *args) -> None:
+        await self.loop.run_in_executor(self._dispatcher, self._call, function, *args)
+
+    async def _serve_client(self, websocket, path=None) -> None:
+        client = self.websocketclass(self, websocket)
+        self.clients.add(client)
+        writer = asyncio.create_task(client._writer())
+        await self._dispatch(client.handleConnected)
+        try:
+            async for message in websocket:
+                await self._dispatch(client._handle_message, message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            client.closed = True
+            writer.cancel()
+            self.clients.discard(client)
+            await self._dispatch(client.handleClose)
+
+    async def _main(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self._stop = self.loop.create_future()
+        async with websockets.serve(
+            self._serve_client,
+            self.host,
+            self.port,
+            ssl=self.ssl_context,
+            compression=self.compression,
+        ):
+            await self._stop
+
+    def serveforever(self) -> None:
+        asyncio.run(self._main())
+
+    def close(self) -> None:
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._stop.set_result, None)